@@ -2,34 +2,32 @@ import os
 
 APP_DOT_PY = (
     """
+from api.limiter import AdaptiveLimiter
+from api.middlewares import (
+    AdaptiveConcurrency,
+    Compression,
+    CustomSuccessHeader,
+    Deadline,
+    RequestMetrics,
+    Tracing,
+)
 from api.routers import register_routers
-from config.environment import Settings
+from config.environment import Settings, get_settings
 from core.utils.generic_exception import CustomHTTPException
 from core.utils.generic_schema import GenericErrorResponseSchema
+from core.utils.tracing import JsonLinesExporter, Tracer
 from fastapi import FastAPI
 from fastapi.encoders import jsonable_encoder
 from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi.staticfiles import StaticFiles
-from infra.database.gino import db
-from starlette.middleware.base import (BaseHTTPMiddleware,
-                                    RequestResponseEndpoint)
+from infra.database.gino import db, pool_metrics, pool_monitor, replicas
+from infra.database.warmup import warm_up
 from starlette.middleware.cors import CORSMiddleware
-from starlette.requests import Request
-from starlette.responses import JSONResponse, Response
+from starlette.responses import JSONResponse
 from toolz import pipe
 
 \ncors_origins = ""
 
-class CustomSuccessHeader(BaseHTTPMiddleware):
-    async def dispatch(
-        self, request: Request, call_next: RequestResponseEndpoint
-    ) -> Response:
-        response = await call_next(request)
-        if response.headers["Content-Type"] == "application/json":
-            response.headers["Content-Type"] = "application/vnd+yobny.store.success+json"  # noqa
-        return response
-
-
 def create_instance(settings: Settings) -> FastAPI:
     cors_origins = [i.strip() for i in settings.CORS_ORIGINS.split(",")]
     return FastAPI(
@@ -39,12 +37,77 @@ def create_instance(settings: Settings) -> FastAPI:
         version=settings.WEB_APP_VERSION,
     )
 
+async def warm_up_db_pool() -> None:
+    settings = get_settings()
+    if settings.DB_WARM_UP:
+        await warm_up.run(
+            db, settings.DB_POOL_MIN_SIZE, prime=not settings.DB_PGBOUNCER
+        )
+    else:
+        warm_up.ready = True
+
+def ready() -> JSONResponse:
+    return JSONResponse(
+        status_code=200 if warm_up.ready else 503, content={"ready": warm_up.ready}
+    )
+
 def init_databases(app: FastAPI) -> FastAPI:
     db.init_app(app=app)
+    # after gino's startup handler has created the pool; uvicorn only
+    # accepts traffic once every startup handler has finished
+    app.add_event_handler("startup", warm_up_db_pool)
+    app.add_api_route("/ready", ready, methods=["GET"], include_in_schema=False)
+    app.add_api_route(
+        "/pool-stats", pool_monitor.stats, methods=["GET"], include_in_schema=False
+    )
+    # after db.init_app, so the primary is bound (and closed) first
+    app.add_event_handler("startup", replicas.connect)
+    app.add_event_handler("shutdown", replicas.close)
+    app.add_api_route(
+        "/replica-stats", replicas.stats, methods=["GET"], include_in_schema=False
+    )
+    # Prometheus scrape target
+    app.add_api_route(
+        "/metrics", pool_metrics.response, methods=["GET"], include_in_schema=False
+    )
+    if get_settings().METRICS_ENABLED:
+        app.add_event_handler("startup", pool_metrics.start)
+    app.add_event_handler("shutdown", pool_metrics.stop)
     return app
 
 def register_middlewares(app: FastAPI) -> FastAPI:
+    settings = get_settings()
     app.add_middleware(CustomSuccessHeader)
+    if settings.LIMITER_ENABLED:
+        limiter = AdaptiveLimiter(
+            pool_monitor,
+            initial=settings.LIMITER_INITIAL,
+            min_limit=settings.LIMITER_MIN,
+            max_limit=settings.LIMITER_MAX,
+            backoff=settings.LIMITER_BACKOFF,
+            tolerance=settings.LIMITER_TOLERANCE,
+            priorities=settings.LIMITER_ROUTE_PRIORITIES.split(","),
+        )
+        app.add_middleware(
+            AdaptiveConcurrency,
+            limiter=limiter,
+            retry_after=settings.LIMITER_RETRY_AFTER,
+        )
+        app.add_api_route(
+            "/limiter-stats", limiter.stats, methods=["GET"], include_in_schema=False
+        )
+    app.add_middleware(
+        Deadline,
+        timeout=settings.REQUEST_TIMEOUT,
+        routes=settings.REQUEST_TIMEOUT_ROUTES.split(","),
+    )
+    app.add_middleware(
+        Compression,
+        minimum_size=settings.COMPRESSION_MIN_SIZE,
+        level=settings.COMPRESSION_LEVEL,
+    )
+    if settings.METRICS_ENABLED:
+        app.add_middleware(RequestMetrics)
     app.add_middleware(
         CORSMiddleware,
         allow_origins=cors_origins,
@@ -52,6 +115,21 @@ def register_middlewares(app: FastAPI) -> FastAPI:
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    if settings.TRACING_ENABLED:
+        tracer = Tracer(
+            JsonLinesExporter(settings.TRACING_FILE),
+            ratio=settings.TRACING_SAMPLE_RATIO,
+            trust_parent=settings.TRACING_TRUST_PARENT,
+        )
+        app.add_middleware(Tracing, tracer=tracer)
+        app.add_event_handler("startup", tracer.exporter.start)
+        app.add_event_handler("shutdown", tracer.exporter.stop)
+        app.add_api_route(
+            "/tracing-stats",
+            tracer.exporter.stats,
+            methods=["GET"],
+            include_in_schema=False,
+        )
     return app
 
 def init_app(settings: Settings) -> FastAPI:
@@ -65,9 +143,414 @@ def init_app(settings: Settings) -> FastAPI:
     return app
 """)
 
+MIDDLEWARES_DOT_PY = (
+    """
+import asyncio
+import time
+import zlib
+
+from api.limiter import AdaptiveLimiter
+from core.utils.deadlines import (
+    TIMEOUT_HEADER,
+    DeadlineExceeded,
+    clear_deadline,
+    gateway_timeout,
+    parse_route_timeouts,
+    reset_timer,
+    set_deadline,
+    set_timer,
+)
+from core.utils.deadlines import reset as reset_deadline
+from core.utils.tracing import TRACEPARENT, Tracer
+from core.utils.tracing import reset as reset_span
+from core.utils.tracing import set_current
+from infra.metrics import observe_request, route_template
+from core.utils.generic_exception import CustomHTTPException
+from core.utils.generic_schema import GenericErrorResponseSchema
+from core.utils.headers import SERVICE_UNAVAILABLE_HEADER
+from core.utils.types import SERVICE_UNAVAILABLE_TYPE
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SUCCESS_MEDIA_TYPE = "application/vnd+yobny.store.success+json"
+
+
+# Pure ASGI: only the "http.response.start" message is rewritten, the body
+# is forwarded as it is sent, without the extra task and memory stream of
+# BaseHTTPMiddleware.
+class CustomSuccessHeader:
+    def __init__(self, app: ASGIApp, media_type: str = SUCCESS_MEDIA_TYPE) -> None:
+        self.app = app
+        self.media_type = media_type.encode("latin-1")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                message["headers"] = [
+                    (key, self.media_type)
+                    if key == b"content-type" and value == b"application/json"
+                    else (key, value)
+                    for key, value in message.get("headers", [])
+                ]
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+# middleware runs outside the exception handlers, so renders its own
+def error_response(exc: CustomHTTPException) -> JSONResponse:
+    return JSONResponse(
+        status_code=exc.status_code,
+        headers=exc.headers,
+        content=GenericErrorResponseSchema(
+            code=exc.status_code,
+            message=exc.message,
+            type=exc.type,
+            details=exc.details,
+        ).dict(by_alias=True),
+    )
+
+
+# Over the limiter's cap a request gets a 503 right away, rather than
+# queueing for a database connection until the client gives up. Time to
+# the response start is the latency sample.
+class AdaptiveConcurrency:
+    def __init__(
+        self, app: ASGIApp, limiter: AdaptiveLimiter, retry_after: int = 1
+    ) -> None:
+        self.app = app
+        self.limiter = limiter
+        self.retry_after = retry_after
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if not self.limiter.acquire(self.limiter.priority(scope["path"])):
+            response = error_response(
+                CustomHTTPException(
+                    status_code=503,
+                    message="Service Unavailable",
+                    details="Too many requests in flight, retry later",
+                    headers={
+                        **SERVICE_UNAVAILABLE_HEADER,
+                        "Retry-After": str(self.retry_after),
+                    },
+                    type=SERVICE_UNAVAILABLE_TYPE,
+                )
+            )
+            await response(scope, receive, send)
+            return
+        start = time.perf_counter()
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                self.limiter.sample(time.perf_counter() - start)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.limiter.release()
+
+
+# Gives each request a deadline (core.utils.deadlines) and cancels it once
+# the deadline passes, answering 504, unless the response has started by
+# then. Database statements and pool waits are capped to the time left, see
+# infra.database.pool, until the body is sent; background tasks run
+# uncapped, and streamed exports opt out early with clear_deadline().
+class Deadline:
+    def __init__(self, app: ASGIApp, timeout: float = 30.0, routes=()) -> None:
+        self.app = app
+        self.timeout = timeout
+        self.routes = parse_route_timeouts(routes)
+
+    def timeout_for(self, scope: Scope) -> float:
+        timeout = self.timeout
+        for prefix, seconds in self.routes:
+            if scope["path"].startswith(prefix):
+                timeout = seconds
+                break
+        requested = Headers(scope=scope).get(TIMEOUT_HEADER)
+        if requested:
+            try:
+                requested = float(requested)
+            except ValueError:
+                requested = 0.0
+            if requested > 0:
+                timeout = min(timeout, requested) if timeout else requested
+        return timeout
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        timeout = self.timeout_for(scope) if scope["type"] == "http" else 0
+        if not timeout:
+            await self.app(scope, receive, send)
+            return
+        started = False
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+                # too late for a 504, and a body cut short is worse
+                timer.cancel()
+            elif message["type"] == "http.response.body" and not message.get(
+                "more_body", False
+            ):
+                # the response's background tasks run next, in this call
+                clear_deadline()
+            await send(message)
+
+        task = asyncio.current_task()
+        expired = False
+
+        def expire() -> None:
+            nonlocal expired
+            expired = True
+            task.cancel()
+
+        # a timer on the request's own task: asyncio.wait_for would run every
+        # request in a task of its own
+        timer = asyncio.get_event_loop().call_later(timeout, expire)
+        timer_token = set_timer(timer)
+        token = set_deadline(timeout)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except asyncio.CancelledError:
+            if not expired:
+                raise
+            if not started:
+                await error_response(gateway_timeout())(scope, receive, send)
+        except DeadlineExceeded:
+            if not started:
+                await error_response(gateway_timeout())(scope, receive, send)
+        finally:
+            timer.cancel()
+            reset_deadline(token)
+            reset_timer(timer_token)
+
+
+# Request count and latency per route template and status class, see
+# infra.metrics. Outermost but for CORS, so time spent shedding and
+# compressing is counted too.
+class RequestMetrics:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        # what ServerErrorMiddleware answers if nothing was sent
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            observe_request(scope, status, time.perf_counter() - start)
+
+
+# Root span of each request (core.utils.tracing), in the caller's trace
+# when it sent a traceparent header. Outermost, so the spans below it leave
+# the time spent in the other middlewares.
+class Tracing:
+    def __init__(self, app: ASGIApp, tracer: Tracer) -> None:
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        root = self.tracer.start(
+            scope["method"],
+            Headers(scope=scope).get(TRACEPARENT),
+            method=scope["method"],
+            path=scope["path"],
+        )
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        token = set_current(root)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except asyncio.CancelledError:
+            root.status = "cancelled"
+            raise
+        except Exception as e:
+            root.status = "error"
+            root.set("error", repr(e)[:200])
+            raise
+        finally:
+            reset_span(token)
+            if root.sampled:
+                route = route_template(scope)
+                root.name = "%s %s" % (scope["method"], route)
+                root.set("route", route)
+                root.set("status_code", status)
+                if status >= 500:
+                    root.status = "error"
+                root.finish()
+
+
+# already compressed, compressing again only costs CPU
+SKIP_COMPRESSION_TYPES = (
+    "image/", "video/", "audio/", "font/woff", "application/zip",
+    "application/gzip", "application/x-gzip", "application/x-brotli",
+    "application/pdf", "application/octet-stream",
+)
+
+
+def accepted_encodings(accept_encoding: str) -> set:
+    accepted = set()
+    for item in accept_encoding.lower().split(","):
+        coding, _, param = item.partition(";")
+        param = param.strip()
+        if param.startswith("q="):
+            try:
+                if float(param[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip())
+    return accepted
+
+
+def choose_encoding(accept_encoding: str, brotli_available: bool = True):
+    # "br" over "gzip" when both are acceptable
+    accepted = accepted_encodings(accept_encoding)
+    if brotli_available and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+class Compression:
+
+    def __init__(
+            self,
+            app: ASGIApp,
+            minimum_size: int = 500,
+            level: int = 6,
+            skip_types=SKIP_COMPRESSION_TYPES) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+        self.skip_types = skip_types
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        encoding = None
+        if scope["type"] == "http" and scope["method"] != "HEAD":
+            encoding = choose_encoding(
+                Headers(scope=scope).get("accept-encoding", ""),
+                brotli is not None)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, _Compressor(self, encoding, send).send)
+
+    def should_compress(self, headers: MutableHeaders, status: int,
+                        body: bytes, more_body: bool) -> bool:
+        if status < 200 or status in (204, 304) or "content-encoding" in headers:
+            return False
+        if "no-transform" in headers.get("cache-control", ""):
+            return False
+        content_type = headers.get("content-type", "").lower()
+        if content_type.startswith(self.skip_types):
+            return content_type.startswith("image/svg")
+        return more_body or len(body) >= self.minimum_size
+
+
+class _Compressor:
+    # one per response: holds "http.response.start" until the first body
+    # message decides whether the response is compressed
+
+    def __init__(self, middleware: Compression, encoding: str, send: Send) -> None:
+        self.middleware = middleware
+        self.encoding = encoding
+        self._send = send
+        self.start = None
+        self.compressor = None
+        self.passthrough = False
+
+    def compress(self, data: bytes, more_body: bool) -> bytes:
+        if self.encoding == "br":
+            data = self.compressor.process(data)
+            return data + (self.compressor.flush() if more_body
+                           else self.compressor.finish())
+        # sync flush, so streamed chunks reach the client as they are sent
+        return self.compressor.compress(data) + self.compressor.flush(
+            zlib.Z_SYNC_FLUSH if more_body else zlib.Z_FINISH)
+
+    async def send(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self._send(message)
+            return
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.compressor is None:
+            # a copy: the list belongs to the Response, which may be sent again
+            headers = MutableHeaders(raw=list(self.start["headers"]))
+            self.start["headers"] = headers.raw
+            if not self.middleware.should_compress(
+                    headers, self.start["status"], body, more_body):
+                self.passthrough = True
+                await self._send(self.start)
+                await self._send(message)
+                return
+            if self.encoding == "br":
+                self.compressor = brotli.Compressor(
+                    quality=min(self.middleware.level, 11))
+            else:
+                self.compressor = zlib.compressobj(
+                    self.middleware.level, zlib.DEFLATED, 31)
+            headers["content-encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            etag = headers.get("etag")
+            if etag and not etag.startswith("W/"):
+                # the compressed body is a different representation
+                headers["etag"] = "W/" + etag
+            del headers["content-length"]
+            body = self.compress(body, more_body)
+            if not more_body:
+                headers["content-length"] = str(len(body))
+            await self._send(self.start)
+        else:
+            body = self.compress(body, more_body)
+        await self._send(
+            {"type": "http.response.body", "body": body, "more_body": more_body})
+    """
+)
+
 ENVIRONMENT_DOT_PY = (
     """
-from typing import Callable
+from typing import Callable, Optional
 
 from dotenv import load_dotenv
 from pydantic import BaseSettings, PostgresDsn
@@ -76,6 +559,60 @@ from pydantic import BaseSettings, PostgresDsn
 class Settings(BaseSettings):
     TEST_ENV: str = "Default"
 
+    COMPRESSION_MIN_SIZE: int = 500
+    COMPRESSION_LEVEL: int = 6
+
+    DB_POOL_MIN_SIZE: int = 3
+    DB_POOL_MAX_SIZE: int = 20
+    DB_POOL_MAX_INACTIVE_LIFETIME: float = 300.0
+    DB_STATEMENT_CACHE_SIZE: int = 100
+    DB_COMMAND_TIMEOUT: Optional[float] = None
+    DB_PGBOUNCER: bool = False
+    # open DB_POOL_MIN_SIZE connections and prime infra.database.warmup's
+    # queries on each before the worker reports ready on /ready
+    DB_WARM_UP: bool = True
+
+    # comma separated DSNs
+    DATABASE_REPLICA_URLS: str = ""
+    DB_REPLICA_HEALTH_INTERVAL: float = 5.0
+    DB_REPLICA_MAX_LAG: float = 10.0
+
+    # adaptive in-flight request cap; comma separated
+    # "path-prefix=critical|high|normal|low" priorities. Off by default: it
+    # sheds normal requests past 80% of the limit, so size LIMITER_INITIAL to
+    # the concurrency a worker is expected to take before turning it on
+    LIMITER_ENABLED: bool = False
+    LIMITER_INITIAL: int = 20
+    LIMITER_MIN: int = 5
+    LIMITER_MAX: int = 200
+    LIMITER_BACKOFF: float = 0.9
+    LIMITER_TOLERANCE: float = 2.0
+    LIMITER_RETRY_AFTER: int = 1
+    LIMITER_ROUTE_PRIORITIES: str = (
+        "/ready=critical,/pool-stats=critical,/limiter-stats=critical,"
+        "/metrics=critical"
+    )
+
+    # request deadlines in seconds, 0 for none; comma separated
+    # "path-prefix=seconds" per route overrides
+    REQUEST_TIMEOUT: float = 30.0
+    REQUEST_TIMEOUT_ROUTES: str = ""
+
+    # Prometheus metrics on /metrics, see infra.metrics for running several
+    # workers; pool gauges are refreshed every interval seconds
+    METRICS_ENABLED: bool = True
+    METRICS_POOL_INTERVAL: float = 5.0
+
+    # Tracing, see core.utils.tracing: this share of requests is traced;
+    # a caller's sampled flag is followed as is only with
+    # TRACING_TRUST_PARENT, for services behind a gateway of ours. Spans are
+    # written as JSON lines to TRACING_FILE, "-" for stdout; nothing rotates
+    # a file
+    TRACING_ENABLED: bool = False
+    TRACING_SAMPLE_RATIO: float = 0.05
+    TRACING_TRUST_PARENT: bool = False
+    TRACING_FILE: str = "-"
+
 
 def _configure_initial_settings() -> Callable[[], Settings]:
     load_dotenv()
@@ -142,6 +679,103 @@ class CustomHTTPException(StarletteHTTPException):
 )
 
 
+LIMITER_DOT_PY = (
+    """
+import time
+
+# share of the limit each priority may fill; critical requests (health
+# checks) are always let in, low priority ones are shed first
+PRIORITY_SHARES = {"critical": None, "high": 1.0, "normal": 0.8, "low": 0.5}
+SHORT_RTT_WEIGHT = 0.1
+LONG_RTT_WEIGHT = 0.01
+
+
+def parse_priorities(items) -> list:
+    # "path-prefix=priority" items, longest prefix first
+    priorities = []
+    for item in items:
+        if not item.strip():
+            continue
+        prefix, _, priority = item.partition("=")
+        priority = priority.strip()
+        if priority not in PRIORITY_SHARES:
+            raise ValueError("Unknown priority %r for %r" % (priority, prefix))
+        priorities.append((prefix.strip(), priority))
+    return sorted(priorities, key=lambda item: -len(item[0]))
+
+
+# AIMD on in-flight requests. Each response start is a latency sample: the
+# limit drops by `backoff` (at most once per typical response time) when
+# requests wait for a pool connection or recent latency exceeds the long
+# run average by `tolerance`, and otherwise grows by about one per limit's
+# worth of responses while the limit is in use.
+class AdaptiveLimiter:
+
+    def __init__(
+            self, pool_monitor=None, initial=20, min_limit=5, max_limit=200,
+            backoff=0.9, tolerance=2.0, priorities=()):
+        self.pool_monitor = pool_monitor
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.priorities = parse_priorities(priorities)
+        self.inflight = 0
+        self.short_rtt = None
+        self.long_rtt = None
+        self.last_decrease = 0.0
+        self.decreases = 0
+        self.admitted = 0
+        self.shed = dict.fromkeys(PRIORITY_SHARES, 0)
+
+    def priority(self, path: str) -> str:
+        for prefix, priority in self.priorities:
+            if path.startswith(prefix):
+                return priority
+        return "normal"
+
+    def acquire(self, priority: str) -> bool:
+        share = PRIORITY_SHARES[priority]
+        if share is not None and self.inflight >= self.limit * share:
+            self.shed[priority] += 1
+            return False
+        self.inflight += 1
+        self.admitted += 1
+        return True
+
+    def release(self) -> None:
+        self.inflight -= 1
+
+    def sample(self, rtt: float) -> None:
+        if self.long_rtt is None:
+            self.short_rtt = self.long_rtt = rtt
+        else:
+            self.short_rtt += (rtt - self.short_rtt) * SHORT_RTT_WEIGHT
+            self.long_rtt += (rtt - self.long_rtt) * LONG_RTT_WEIGHT
+        waiting = self.pool_monitor.waiting if self.pool_monitor else 0
+        if waiting or self.short_rtt > self.long_rtt * self.tolerance:
+            now = time.monotonic()
+            if now - self.last_decrease >= self.long_rtt:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self.last_decrease = now
+                self.decreases += 1
+        elif self.inflight >= self.limit / 2:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "inflight": self.inflight,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "decreases": self.decreases,
+            "short_rtt": self.short_rtt,
+            "long_rtt": self.long_rtt,
+        }
+    """
+)
+
 GENERIC_SCHEMA_DOT_PY = (
     """
 from typing import Any, Optional
@@ -177,6 +811,358 @@ class SuccessResponseSchema(BaseModel):
     """
 )
 
+DEADLINES_DOT_PY = (
+    """
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from core.utils.generic_exception import CustomHTTPException
+from core.utils.headers import GATEWAY_TIMEOUT_HEADER
+from core.utils.types import GATEWAY_TIMEOUT_TYPE
+
+# a client may shorten, never extend, its request's deadline with this
+TIMEOUT_HEADER = "X-Request-Timeout"
+
+# time.monotonic() by which the current request must be answered, and the
+# timer that cancels it then; set by api.middlewares.Deadline
+_deadline = ContextVar("deadline", default=None)
+_timer = ContextVar("deadline_timer", default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def parse_route_timeouts(items) -> list:
+    # "path-prefix=seconds" items, longest prefix first; 0 is no deadline
+    timeouts = []
+    for item in items:
+        if not item.strip():
+            continue
+        prefix, _, seconds = item.partition("=")
+        timeouts.append((prefix.strip(), float(seconds)))
+    return sorted(timeouts, key=lambda item: -len(item[0]))
+
+
+def set_deadline(seconds: float):
+    return _deadline.set(time.monotonic() + seconds)
+
+
+def reset(token) -> None:
+    _deadline.reset(token)
+
+
+def set_timer(timer):
+    return _timer.set(timer)
+
+
+def reset_timer(token) -> None:
+    _timer.reset(token)
+
+
+def clear_deadline() -> None:
+    # for a response that may rightly outlive the deadline, e.g. a streamed
+    # export: its statements are no longer capped, nor is it cancelled
+    _deadline.set(None)
+    timer = _timer.get()
+    if timer is not None:
+        timer.cancel()
+
+
+def remaining() -> Optional[float]:
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+# The timeout for a blocking call, `timeout` capped to what is left of the
+# request's deadline; pass it on to outbound calls as well:
+#
+#     requests.get(url, timeout=budget(5.0), headers=outbound_headers())
+def budget(timeout: Optional[float] = None) -> Optional[float]:
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded()
+    return left if timeout is None else min(timeout, left)
+
+
+def outbound_headers() -> dict:
+    # downstream services of ours then stop when we would
+    left = remaining()
+    if left is None:
+        return {}
+    return {TIMEOUT_HEADER: "%.3f" % max(left, 0.0)}
+
+
+def gateway_timeout() -> CustomHTTPException:
+    return CustomHTTPException(
+        status_code=504,
+        message="Gateway Timeout",
+        details="The request deadline passed",
+        headers=GATEWAY_TIMEOUT_HEADER,
+        type=GATEWAY_TIMEOUT_TYPE,
+    )
+    """
+)
+
+
+TRACING_DOT_PY = (
+    """
+import asyncio
+import json
+import logging
+import random
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# W3C trace context, https://www.w3.org/TR/trace-context/
+TRACEPARENT = "traceparent"
+HEX = set("0123456789abcdef")
+# longer statements are cut in the exported span
+STATEMENT_MAX_LENGTH = 2000
+
+_current = ContextVar("span", default=None)
+
+
+class Span:
+    __slots__ = (
+        "tracer",
+        "name",
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "sampled",
+        "attributes",
+        "status",
+        "start",
+        "_started",
+    )
+
+    def __init__(self, tracer, name, trace_id, parent_id, sampled, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = attributes
+        self.status = "ok"
+        self.start = time.time()
+        self._started = time.perf_counter()
+
+    def set(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def traceparent(self) -> str:
+        return "00-%s-%s-%s" % (
+            self.trace_id,
+            self.span_id,
+            "01" if self.sampled else "00",
+        )
+
+    def child(self, name: str, attributes: dict) -> "Span":
+        return Span(
+            self.tracer, name, self.trace_id, self.span_id, self.sampled, attributes
+        )
+
+    def finish(self) -> None:
+        if self.sampled:
+            self.tracer.exporter.export(
+                {
+                    "trace_id": self.trace_id,
+                    "span_id": self.span_id,
+                    "parent_id": self.parent_id,
+                    "name": self.name,
+                    "start": self.start,
+                    "duration_ms": (time.perf_counter() - self._started) * 1000,
+                    "status": self.status,
+                    "attributes": self.attributes,
+                }
+            )
+
+
+def parse_traceparent(value: Optional[str]):
+    # (trace id, parent span id, sampled), or None if absent or invalid
+    if not value:
+        return None
+    parts = value.strip().split("-")
+    if len(parts) < 4:
+        return None
+    version, trace_id, parent_id, flags = parts[:4]
+    if (
+        len(version) != 2
+        or version == "ff"
+        or len(trace_id) != 32
+        or len(parent_id) != 16
+        or len(flags) != 2
+        or (version == "00" and len(parts) != 4)
+        or not set(version + trace_id + parent_id + flags) <= HEX
+        or trace_id == "0" * 32
+        or parent_id == "0" * 16
+    ):
+        return None
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def set_current(span: Optional[Span]):
+    return _current.set(span)
+
+
+def reset(token) -> None:
+    _current.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    # a child of the current span; nothing is recorded when the request is
+    # not sampled, or outside a request
+    parent = _current.get()
+    if parent is None or not parent.sampled:
+        yield None
+        return
+    child = parent.child(name, attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except asyncio.CancelledError:
+        child.status = "cancelled"
+        raise
+    except Exception as e:
+        child.status = "error"
+        child.attributes["error"] = repr(e)[:200]
+        raise
+    finally:
+        _current.reset(token)
+        child.finish()
+
+
+# Headers for an outbound call, so the service called joins the trace:
+#
+#     with span("http_client", url=url):
+#         await client.get(url, timeout=budget(5.0),
+#                          headers=inject(outbound_headers()))
+def inject(headers: Optional[dict] = None) -> dict:
+    headers = dict(headers or {})
+    current = _current.get()
+    if current is not None:
+        headers[TRACEPARENT] = current.traceparent()
+    return headers
+
+
+class Tracer:
+    def __init__(
+        self, exporter, ratio: float = 0.05, trust_parent: bool = False
+    ) -> None:
+        self.exporter = exporter
+        self.ratio = ratio
+        self.bound = int(ratio * (1 << 64))
+        self.trust_parent = trust_parent
+
+    def sampled(self, trace_id: str) -> bool:
+        # on the low 64 bits of the trace id, as OpenTelemetry's
+        # TraceIdRatioBased, so services with one ratio agree on a trace
+        return int(trace_id[16:], 16) < self.bound
+
+    def start(self, name: str, traceparent: Optional[str] = None, **attributes) -> Span:
+        # a root span, continuing the caller's trace when it sent a valid
+        # traceparent. Its sampled flag is followed as is only from trusted
+        # callers; from others it is sampled at the ratio too, by a coin
+        # toss, as they pick the trace id
+        parent = parse_traceparent(traceparent)
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+            if sampled and not self.trust_parent:
+                sampled = random.random() < self.ratio
+        else:
+            trace_id = "%032x" % random.getrandbits(128)
+            parent_id = None
+            sampled = self.sampled(trace_id)
+        return Span(self, name, trace_id, parent_id, sampled, attributes)
+
+
+# Writes finished spans as JSON lines to a file, or stdout for "-". Spans
+# are queued in memory and written every flush_interval seconds off the
+# event loop; past max_queue they are dropped and counted.
+class JsonLinesExporter:
+    def __init__(
+        self, path: str = "-", flush_interval: float = 1.0, max_queue: int = 10000
+    ) -> None:
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.queue = []
+        self.exported = 0
+        self.dropped = 0
+        self._task = None
+
+    def export(self, record: dict) -> None:
+        if len(self.queue) >= self.max_queue:
+            self.dropped += 1
+            return
+        self.queue.append(record)
+
+    async def start(self) -> None:
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("exporting spans failed")
+
+    async def flush(self) -> None:
+        if not self.queue:
+            return
+        records, self.queue = self.queue, []
+        await asyncio.get_event_loop().run_in_executor(None, self.write, records)
+        self.exported += len(records)
+
+    def write(self, records: list) -> None:
+        # in the executor, encoding included
+        data = "".join(
+            json.dumps(record, default=str, separators=(",", ":")) + "\\n"
+            for record in records
+        )
+        if self.path == "-":
+            sys.stdout.write(data)
+            sys.stdout.flush()
+            return
+        with open(self.path, "a") as output:
+            output.write(data)
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self.queue),
+            "exported": self.exported,
+            "dropped": self.dropped,
+        }
+    """
+)
+
+
 HEADERS_DOT_PY = (
     """
 from typing_extensions import Final
@@ -186,6 +1172,8 @@ NOT_FOUND_HEADER: Final = {"Content-Type": "application/vnd+______.service.entit
 NOT_ACCEPTABLE_HEADER: Final = {"Content-Type": "application/vnd+______.service.entity.not-acceptable+json"}  # noqa
 INTERNAL_SERVER_ERROR_HEADER: Final = {"Content-Type": "application/vnd+______.service.internal-server-error+json"}  # noqa
 BAD_REQUEST_HEADER: Final = {"Content-Type": "application/vnd+______.service.bad-request+json"}  # noqa
+SERVICE_UNAVAILABLE_HEADER: Final = {"Content-Type": "application/vnd+______.service.unavailable+json"}  # noqa
+GATEWAY_TIMEOUT_HEADER: Final = {"Content-Type": "application/vnd+______.service.gateway-timeout+json"}  # noqa
 SUCCESS_RESPONSE_TYPE: Final = "application/vnd+yobny.______.success+json"
     """
 )
@@ -193,13 +1181,16 @@ SUCCESS_RESPONSE_TYPE: Final = "application/vnd+yobny.______.success+json"
 
 HELPERS_DOT_PY = (
     """
+import asyncio
 from functools import wraps
 from typing import Any, Callable, Dict, List
 
 from humps import camelize
 
+from .deadlines import DeadlineExceeded, gateway_timeout
 from .generic_exception import *
 from .headers import *
+from .tracing import span
 from .types import *
 
 
@@ -211,7 +1202,8 @@ def exception_handler(f):
     @wraps(f)
     async def decorator(*args, **kwargs):
         try:
-            return await f(*args, **kwargs)
+            with span("handler", function=f.__qualname__):
+                return await f(*args, **kwargs)
         except NotFoundException as e:
             raise CustomHTTPException(
                 status_code=404,
@@ -228,6 +1220,12 @@ def exception_handler(f):
                 headers=BAD_REQUEST_HEADER,
                 type=BAD_REQUEST_TYPE,
             )
+        except DeadlineExceeded:
+            raise gateway_timeout()
+        except asyncio.CancelledError:
+            # an Exception before python 3.8; the request is being cancelled,
+            # e.g. by its deadline, there is no one to answer
+            raise
         except Exception as e:
             # e can be empty sometimes
             if str(e) in ["", None, " ", False]:
@@ -258,6 +1256,8 @@ NOT_ACCEPTABLE_TYPE: Final = "vnd._____.service.entity.not-acceptable"
 INTERNAL_SERVER_ERROR_TYPE: Final = "vnd._____.service.internal-server-error"
 BAD_REQUEST_TYPE: Final = "vnd._____.service.bad_request"
 PARTIAL_CONTENT_TYPE: Final = "vnd._____.service.partial-content"
+SERVICE_UNAVAILABLE_TYPE: Final = "vnd._____.service.unavailable"
+GATEWAY_TIMEOUT_TYPE: Final = "vnd._____.service.gateway-timeout"
     """
 )
 
@@ -269,8 +1269,44 @@ from ssl import create_default_context
 
 from config.environment import get_settings
 from gino_starlette import Gino
+from infra.database.pool import DeadlineConnection, PoolMonitor
+from infra.database.replicas import ReplicaSet
+from infra.metrics import InstrumentedConnection, PoolMetrics
 
 settings = get_settings()
+pool_monitor = PoolMonitor()
+
+# passed through gino to asyncpg.create_pool; pgbouncer in transaction mode
+# cannot keep named prepared statements, so the statement cache is disabled
+pool_options = dict(
+    pool_class=pool_monitor.pool_class(),
+    connection_class=(
+        InstrumentedConnection
+        if settings.METRICS_ENABLED or settings.TRACING_ENABLED
+        else DeadlineConnection
+    ),
+    max_inactive_connection_lifetime=settings.DB_POOL_MAX_INACTIVE_LIFETIME,
+    statement_cache_size=(
+        0 if settings.DB_PGBOUNCER else settings.DB_STATEMENT_CACHE_SIZE
+    ),
+    command_timeout=settings.DB_COMMAND_TIMEOUT,
+)
+# replicas get their own pools (and monitors) with the same options
+replica_options = dict(
+    pool_options,
+    min_size=settings.DB_POOL_MIN_SIZE,
+    max_size=settings.DB_POOL_MAX_SIZE,
+)
+del replica_options["pool_class"]
+
+replica_urls = [
+    dsn.strip() for dsn in settings.DATABASE_REPLICA_URLS.split(",") if dsn.strip()
+]
+# With replicas, no lazy connection per request: a request's reads are
+# routed one by one (infra.database.replicas) and take a pooled connection
+# only for the statement; db.transaction() / db.acquire() still pin their
+# block to one connection.
+use_connection_for_request = not replica_urls
 
 if settings.ENV == "prod":
     ssl_object = create_default_context(cafile=settings.SSL_CERT_FILE)
@@ -278,16 +1314,625 @@ if settings.ENV == "prod":
         dsn=settings.DATABASE_PG_URL,
         echo=False,
         ssl=ssl_object,
-        pool_min_size=3,
-        pool_max_size=20,
+        pool_min_size=settings.DB_POOL_MIN_SIZE,
+        pool_max_size=settings.DB_POOL_MAX_SIZE,
         retry_limit=1,
         retry_interval=1,
+        use_connection_for_request=use_connection_for_request,
+        kwargs=pool_options,
     )
+    replica_options["ssl"] = ssl_object
 else:
     db: Gino = Gino(
         dsn=settings.DATABASE_PG_URL,
-        echo=True
+        echo=True,
+        pool_min_size=settings.DB_POOL_MIN_SIZE,
+        pool_max_size=settings.DB_POOL_MAX_SIZE,
+        use_connection_for_request=use_connection_for_request,
+        kwargs=pool_options,
     )
+
+replicas = ReplicaSet(
+    db,
+    replica_urls,
+    health_interval=settings.DB_REPLICA_HEALTH_INTERVAL,
+    max_lag=settings.DB_REPLICA_MAX_LAG,
+    **replica_options,
+)
+
+pool_metrics = PoolMetrics(
+    pool_monitor, replicas, interval=settings.METRICS_POOL_INTERVAL
+)
+    """
+)
+
+
+METRICS_DOT_PY = (
+    """
+import asyncio
+import logging
+import os
+import time
+
+from core.utils.tracing import STATEMENT_MAX_LENGTH, span
+from infra.database.pool import DeadlineConnection
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from starlette.responses import Response
+from starlette.types import Scope
+
+logger = logging.getLogger(__name__)
+
+# Under several uvicorn/gunicorn workers, export PROMETHEUS_MULTIPROC_DIR
+# (an empty directory, cleared before the server starts) in the process
+# environment: each worker then writes its samples there and /metrics adds
+# them up across workers. It is read when this module is imported.
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+OPERATIONS = {
+    "select",
+    "insert",
+    "update",
+    "delete",
+    "with",
+    "begin",
+    "commit",
+    "rollback",
+    "copy",
+}
+# up to the default request deadline
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUERY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+REQUESTS = Counter(
+    "http_requests_total",
+    "HTTP requests by route template and status class",
+    ("method", "route", "status"),
+)
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Time to the end of the response body",
+    ("method", "route"),
+    buckets=REQUEST_BUCKETS,
+)
+QUERY_DURATION = Histogram(
+    "db_query_duration_seconds",
+    "asyncpg statement time, results included",
+    ("operation",),
+    buckets=QUERY_BUCKETS,
+)
+# livesum: the sum over the workers that are still running
+POOL_CONNECTIONS = Gauge(
+    "db_pool_connections",
+    "Open pool connections by state",
+    ("pool", "state"),
+    multiprocess_mode="livesum",
+)
+POOL_MAX_SIZE = Gauge(
+    "db_pool_max_size", "Pool size limit", ("pool",), multiprocess_mode="livesum"
+)
+POOL_WAITING = Gauge(
+    "db_pool_waiting",
+    "Callers waiting for a connection",
+    ("pool",),
+    multiprocess_mode="livesum",
+)
+
+# labels() takes a lock and builds a key on every call; on the hot path the
+# children are looked up here once per label set instead
+_request_children = {}
+_query_children = {}
+
+
+def route_template(scope: Scope) -> str:
+    # the path the route was declared with, so /tests/{id} is one series
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    app = scope["app"]
+    routes = getattr(app, "route_templates", None)
+    if routes is None:
+        routes = app.route_templates = {
+            getattr(route, "endpoint", None) or route.app: route.path
+            for route in app.routes}
+    return routes.get(endpoint, "unmatched")
+
+
+def observe_request(scope: Scope, status: int, elapsed: float) -> None:
+    method = scope["method"] if scope["method"] in METHODS else "other"
+    key = (method, route_template(scope), status // 100)
+    children = _request_children.get(key)
+    if children is None:
+        children = _request_children[key] = (
+            REQUESTS.labels(key[0], key[1], "%dxx" % key[2]),
+            REQUEST_DURATION.labels(key[0], key[1]),
+        )
+    children[0].inc()
+    children[1].observe(elapsed)
+
+
+def observe_query(query: str, elapsed: float) -> None:
+    words = query[:16].split(None, 1)
+    operation = words[0].lower() if words else ""
+    if operation not in OPERATIONS:
+        operation = "other"
+    child = _query_children.get(operation)
+    if child is None:
+        child = _query_children[operation] = QUERY_DURATION.labels(operation)
+    child.observe(elapsed)
+
+
+# connection_class for the pools when metrics or tracing are enabled:
+# statement durations, and a span per statement in traced requests
+class InstrumentedConnection(DeadlineConnection):
+    async def _do_execute(self, query, executor, timeout, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            with span("db_query", statement=query[:STATEMENT_MAX_LENGTH]):
+                return await super()._do_execute(
+                    query, executor, timeout, *args, **kwargs
+                )
+        finally:
+            observe_query(query, time.perf_counter() - start)
+
+
+# Copies the PoolMonitor numbers of the primary and the replicas into the
+# pool gauges every `interval` seconds, and on each scrape.
+class PoolMetrics:
+    def __init__(self, pool_monitor, replicas, interval: float = 5.0) -> None:
+        self.pool_monitor = pool_monitor
+        self.replicas = replicas
+        self.interval = interval
+        self._task = None
+
+    def monitors(self):
+        yield "primary", self.pool_monitor
+        for replica in self.replicas.replicas:
+            yield replica.name, replica.monitor
+
+    def update(self) -> None:
+        for name, monitor in self.monitors():
+            stats = monitor.stats()
+            if not stats:
+                continue
+            POOL_CONNECTIONS.labels(name, "in_use").set(stats["in_use"])
+            POOL_CONNECTIONS.labels(name, "idle").set(stats["idle"])
+            POOL_MAX_SIZE.labels(name).set(stats["max_size"])
+            POOL_WAITING.labels(name).set(stats["waiting"])
+
+    async def start(self) -> None:
+        self.update()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if MULTIPROCESS:
+            # drops this worker's livesum gauges
+            multiprocess.mark_process_dead(os.getpid())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.update()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("updating pool metrics failed")
+
+    def response(self) -> Response:
+        self.update()
+        if MULTIPROCESS:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    """
+)
+
+
+POOL_DOT_PY = (
+    """
+import asyncio
+import time
+
+from asyncpg import Connection
+from core.utils.deadlines import DeadlineExceeded, budget
+from gino.dialects.asyncpg import Pool
+
+
+class MonitoredPool(Pool):
+    # gino creates the pool from the class it is given, so the monitor is
+    # bound through PoolMonitor.pool_class()
+    monitor = None
+
+    async def _init(self):
+        await super()._init()
+        self.monitor.pool = self._pool
+        return self
+
+    async def acquire(self, *, timeout=None):
+        capped = budget(timeout)
+        try:
+            return await self.monitor.timed(self._pool.acquire(timeout=capped))
+        except asyncio.TimeoutError:
+            if capped != timeout:
+                raise DeadlineExceeded()
+            raise
+
+
+# connection_class for the pools: statement timeouts are capped to what is
+# left of the request deadline. asyncpg cancels a timed out statement on the
+# server, so the connection goes back to the pool right away.
+class DeadlineConnection(Connection):
+    async def _do_execute(self, query, executor, timeout, *args, **kwargs):
+        if timeout is None:
+            timeout = self._config.command_timeout
+        capped = budget(timeout)
+        try:
+            return await super()._do_execute(query, executor, capped, *args, **kwargs)
+        except asyncio.TimeoutError:
+            if capped != timeout:
+                raise DeadlineExceeded()
+            raise
+
+
+class PoolMonitor:
+
+    def __init__(self) -> None:
+        self.pool = None
+        self.waiting = 0
+        self.acquired = 0
+        self.acquire_wait_total = 0.0
+        self.acquire_wait_max = 0.0
+
+    def pool_class(self):
+        return type("MonitoredPool", (MonitoredPool,), {"monitor": self})
+
+    async def timed(self, acquire):
+        # only a caller that finds no idle connection is queued; the limiter
+        # reads any waiter as saturation
+        queued = self.pool is not None and self.pool.get_idle_size() == 0
+        self.waiting += queued
+        start = time.perf_counter()
+        try:
+            return await acquire
+        finally:
+            elapsed = time.perf_counter() - start
+            self.waiting -= queued
+            self.acquired += 1
+            self.acquire_wait_total += elapsed
+            self.acquire_wait_max = max(self.acquire_wait_max, elapsed)
+
+    def stats(self) -> dict:
+        if self.pool is None:
+            return {}
+        size = self.pool.get_size()
+        idle = self.pool.get_idle_size()
+        return {
+            "min_size": self.pool.get_min_size(),
+            "max_size": self.pool.get_max_size(),
+            "size": size,
+            "in_use": size - idle,
+            "idle": idle,
+            "waiting": self.waiting,
+            "acquired": self.acquired,
+            "acquire_wait_avg": (
+                self.acquire_wait_total / self.acquired if self.acquired else 0.0),
+            "acquire_wait_max": self.acquire_wait_max,
+        }
+    """
+)
+
+
+WARMUP_DOT_PY = (
+    """
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Registry of hot queries, primed on every pooled connection before the
+# worker reports ready. Register cheap, representative statements, e.g.
+#     warm_up.register(Test.query.where(Test.id == db.bindparam("id")), id=uuid4())
+#     warm_up.register("SELECT count(*) FROM test WHERE created > $1", datetime.utcnow())
+class WarmUp:
+    def __init__(self) -> None:
+        self.queries = []
+        self.ready = False
+
+    def register(self, query, *args, **params):
+        self.queries.append((query, args, params))
+        return query
+
+    def compile(self, dialect):
+        statements = []
+        for query, args, params in self.queries:
+            if isinstance(query, str):
+                statements.append((query, args))
+                continue
+            # the same text Gino sends, so the statement cache entry is reused
+            compiled = query.compile(dialect=dialect)
+            values = compiled.construct_params(params)
+            statements.append(
+                (
+                    str(compiled),
+                    tuple(values[name] for name in compiled.positiontup or ()),
+                )
+            )
+        return statements
+
+    async def prime(self, conn, statements) -> None:
+        for sql, args in statements:
+            # prepared statements outlive the rollback; any writes do not
+            transaction = conn.transaction()
+            await transaction.start()
+            try:
+                await conn.fetch(sql, *args)
+            except Exception:
+                logger.exception("Warm-up query failed: %s", sql)
+            finally:
+                await transaction.rollback()
+
+    async def run(self, db, connections: int, prime: bool = True) -> None:
+        pool = db.bind.raw_pool
+        statements = self.compile(db.bind.dialect) if prime else []
+        acquired = await asyncio.gather(
+            *(pool.acquire() for _ in range(connections)), return_exceptions=True
+        )
+        try:
+            for conn in acquired:
+                if isinstance(conn, BaseException):
+                    raise conn
+            await asyncio.gather(*(self.prime(conn, statements) for conn in acquired))
+        finally:
+            await asyncio.gather(
+                *(
+                    pool.release(conn)
+                    for conn in acquired
+                    if not isinstance(conn, BaseException)
+                )
+            )
+        self.ready = True
+        logger.info(
+            "Warmed %d connections with %d statements", len(acquired), len(statements)
+        )
+
+
+warm_up = WarmUp()
+    """
+)
+
+
+REPLICAS_DOT_PY = (
+    """
+import asyncio
+import itertools
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from asyncpg.exceptions import (
+    AdminShutdownError, CannotConnectNowError, ConnectionDoesNotExistError,
+    PostgresConnectionError)
+from gino import create_engine
+from sqlalchemy import text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.expression import Select
+from infra.database.pool import PoolMonitor
+
+logger = logging.getLogger(__name__)
+
+# errors after which a read is retried on the primary
+FAILOVER_ERRORS = (
+    OSError, ConnectionDoesNotExistError, PostgresConnectionError,
+    CannotConnectNowError, AdminShutdownError)
+
+# replay lag in seconds; 0 when everything received has been replayed
+# (and on a server that is not in recovery)
+LAG_QUERY = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+    "THEN 0 ELSE COALESCE(EXTRACT(EPOCH FROM "
+    "now() - pg_last_xact_replay_timestamp()), 0) END")
+
+# set once the current request has written, so its later reads see the write
+_sticky = ContextVar("replicas_sticky", default=False)
+_forced = ContextVar("replicas_forced", default=False)
+
+
+def mark_write():
+    _sticky.set(True)
+
+
+async def use_primary():
+    # Depends(use_primary): every read of the request goes to the primary
+    mark_write()
+
+
+@contextmanager
+def primary():
+    token = _forced.set(True)
+    try:
+        yield
+    finally:
+        _forced.reset(token)
+
+
+class Replica:
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.name = repr(make_url(dsn))
+        self.monitor = PoolMonitor()
+        self.engine = None
+        self.healthy = False
+        self.lag = None
+        self.error = None
+
+    def stats(self) -> dict:
+        return {
+            "url": self.name,
+            "healthy": self.healthy,
+            "lag": self.lag,
+            "error": self.error,
+            "pool": self.monitor.stats(),
+        }
+
+
+class RoutingEngine:
+    # stands in for the primary engine as db.bind: SELECTs go to a healthy
+    # replica, everything else (and the rest of the engine API) to the primary
+
+    def __init__(self, primary, replicas):
+        self.primary = primary
+        self.replicas = replicas
+
+    def __getattr__(self, name):
+        return getattr(self.primary, name)
+
+    def route(self, clause):
+        if not isinstance(clause, Select):
+            mark_write()
+            return None
+        # a current connection means an explicit transaction or acquire,
+        # whose reads must see its own writes
+        if (clause._for_update_arg is not None or _sticky.get()
+                or _forced.get() or self.primary.current_connection is not None):
+            return None
+        return self.replicas.choose()
+
+    async def _execute(self, method, clause, *multiparams, **params):
+        replica = self.route(clause)
+        if replica is not None:
+            try:
+                return await getattr(replica.engine, method)(
+                    clause, *multiparams, **params)
+            except FAILOVER_ERRORS as e:
+                self.replicas.mark_down(replica, e)
+        return await getattr(self.primary, method)(
+            clause, *multiparams, **params)
+
+    async def all(self, clause, *multiparams, **params):
+        return await self._execute("all", clause, *multiparams, **params)
+
+    async def first(self, clause, *multiparams, **params):
+        return await self._execute("first", clause, *multiparams, **params)
+
+    async def one(self, clause, *multiparams, **params):
+        return await self._execute("one", clause, *multiparams, **params)
+
+    async def one_or_none(self, clause, *multiparams, **params):
+        return await self._execute(
+            "one_or_none", clause, *multiparams, **params)
+
+    async def scalar(self, clause, *multiparams, **params):
+        return await self._execute("scalar", clause, *multiparams, **params)
+
+    async def status(self, clause, *multiparams, **params):
+        mark_write()
+        return await self.primary.status(clause, *multiparams, **params)
+
+
+class ReplicaSet:
+
+    def __init__(self, db, dsns, health_interval=5.0, max_lag=10.0,
+                 **engine_options):
+        self.db = db
+        self.replicas = [Replica(dsn) for dsn in dsns]
+        self.health_interval = health_interval
+        self.max_lag = max_lag
+        self.engine_options = engine_options
+        self._next = itertools.count()
+        self._health_task = None
+
+    def choose(self):
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self._next) % len(healthy)]
+
+    def mark_down(self, replica, error):
+        logger.warning("replica %s failed, using primary: %r",
+                       replica.name, error)
+        replica.healthy = False
+        replica.error = repr(error)
+
+    async def connect(self):
+        # after gino's startup handler has bound the primary
+        if not self.replicas:
+            return
+        await self.check()
+        self.db.bind = RoutingEngine(self.db.bind, self)
+        self._health_task = asyncio.ensure_future(self._health_loop())
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+            self._health_task = None
+        for replica in self.replicas:
+            if replica.engine is not None:
+                await replica.engine.close()
+                replica.engine = None
+            replica.healthy = False
+
+    async def check(self):
+        await asyncio.gather(*(self._check(replica) for replica in self.replicas))
+
+    async def _check(self, replica):
+        try:
+            if replica.engine is None:
+                replica.engine = await asyncio.wait_for(create_engine(
+                    replica.dsn, pool_class=replica.monitor.pool_class(),
+                    **self.engine_options), self.health_interval)
+            lag = await asyncio.wait_for(
+                replica.engine.scalar(LAG_QUERY), self.health_interval)
+        except Exception as e:  # noqa
+            if replica.healthy or replica.error is None:
+                logger.warning("replica %s is down: %r", replica.name, e)
+            replica.healthy = False
+            replica.error = repr(e)
+            return
+        replica.lag = float(lag)
+        replica.healthy = replica.lag <= self.max_lag
+        replica.error = None if replica.healthy else "lagging"
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.check()
+
+    def stats(self) -> list:
+        return [replica.stats() for replica in self.replicas]
     """
 )
 
@@ -373,6 +2018,10 @@ def task_create_directories():
                 easy_dir(f"{root_path}/api", "routers")
                 with open(f"{root_path}/api/app.py", "a") as output:
                     output.write(APP_DOT_PY)
+                with open(f"{root_path}/api/middlewares.py", "a") as output:
+                    output.write(MIDDLEWARES_DOT_PY)
+                with open(f"{root_path}/api/limiter.py", "a") as output:
+                    output.write(LIMITER_DOT_PY)
 
             if items == 'config':
                 with open(f"{root_path}/config/environment.py", "a") as output:
@@ -393,6 +2042,10 @@ def task_create_directories():
                     output.write(HELPERS_DOT_PY)
                 with open(f"{root_path}/core/utils/types.py", "a") as output:
                     output.write(TYPES_DOT_PY)
+                with open(f"{root_path}/core/utils/deadlines.py", "a") as output:
+                    output.write(DEADLINES_DOT_PY)
+                with open(f"{root_path}/core/utils/tracing.py", "a") as output:
+                    output.write(TRACING_DOT_PY)
 
             if items == 'infra':
                 easy_dir(f"{root_path}/infra", "database")
@@ -401,6 +2054,14 @@ def task_create_directories():
                     easy_dir(f"{root_path}/infra/database", di)
                 with open(f"{root_path}/infra/database/gino.py", "a") as output:
                     output.write(GINO_DOT_PY)
+                with open(f"{root_path}/infra/database/pool.py", "a") as output:
+                    output.write(POOL_DOT_PY)
+                with open(f"{root_path}/infra/database/warmup.py", "a") as output:
+                    output.write(WARMUP_DOT_PY)
+                with open(f"{root_path}/infra/metrics.py", "a") as output:
+                    output.write(METRICS_DOT_PY)
+                with open(f"{root_path}/infra/database/replicas.py", "a") as output:
+                    output.write(REPLICAS_DOT_PY)
 
     except:
         pass
@@ -448,8 +2109,9 @@ def task_install_dependencies():
         " googleapis-common-protos==1.54.0 greenlet==1.1.2 grpcio==1.43.0"
         " grpcio-status==1.43.0 h11==0.12.0 httplib2==0.20.2 idna==3.3"
         " importlib-metadata==1.7.0 importlib-resources==5.4.0 Mako==1.1.6"
-        " MarkupSafe==2.0.1 msgpack==1.0.3 packaging==21.3 proto-plus==1.19.8"
-        " protobuf==3.19.3 psycopg2==2.9.3 pyasn1==0.4.8 pyasn1-modules==0.2.8"
+        " MarkupSafe==2.0.1 msgpack==1.0.3 packaging==21.3"
+        " prometheus-client==0.12.0 proto-plus==1.19.8 protobuf==3.19.3"
+        " psycopg2==2.9.3 pyasn1==0.4.8 pyasn1-modules==0.2.8"
         " pycodestyle==2.8.0 pydantic==1.9.0 pyhumps==3.5.0 pyparsing==3.0.6"
         " python-dateutil==2.8.2 pytz==2021.3 requests==2.27.1 rsa==4.8"
         " six==1.16.0 sniffio==1.2.0 SQLAlchemy==1.3.24 SQLAlchemy-Utils==0.38.2"
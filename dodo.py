@@ -109,6 +109,31 @@ class SuccessResponseSchema(BaseModel):
         alias_generator = to_camel
         allow_population_by_field_name = True
 """
+BATCH_SCHEMA = """
+from typing import Any, Dict, List, Optional
+from pydantic import BaseModel, Field
+from app.utils.helper import to_camel
+
+
+class BatchItemSchema(BaseModel):
+    id: Optional[str]
+    method: str = Field("GET", regex="^(GET|HEAD|OPTIONS|POST|PUT|PATCH|DELETE)$")
+    path: str = Field(..., regex="^/")
+    headers: Dict[str, str] = {}
+    body: Any
+
+    class Config:
+        alias_generator = to_camel
+        allow_population_by_field_name = True
+
+
+class BatchRequestSchema(BaseModel):
+    requests: List[BatchItemSchema]
+
+    class Config:
+        alias_generator = to_camel
+        allow_population_by_field_name = True
+"""
 TEST_MODELS = """
 from typing import Awaitable
 from uuid import UUID
@@ -129,8 +154,9 @@ from fastapi.openapi.models import APIKey
 from fastapi.param_functions import Depends
 from fastapi import APIRouter
 from app.db.models import Test
+from app.utils.negotiation import MsgPackRoute
 
-router = APIRouter()
+router = APIRouter(route_class=MsgPackRoute)
 
 """
 
@@ -145,53 +171,198 @@ export DB_PORT=5432
 
 MAIN_FILE = """
 
+import os
 import uvicorn
 from fastapi import FastAPI
-from fastapi.encoders import jsonable_encoder
 from fastapi.openapi.utils import get_openapi
 from fastapi.openapi.docs import get_swagger_ui_html
 from starlette.requests import Request
-from starlette.responses import JSONResponse, Response
+from starlette.responses import JSONResponse
 from starlette.middleware.cors import CORSMiddleware
-from starlette.middleware.base import (
-    BaseHTTPMiddleware,
-    RequestResponseEndpoint)
-from app.core.extensions import db
+from app.core.extensions import (
+    db, invalidator, limiter, pool_metrics, pool_monitor, replicas, tracer,
+    write_behind)
 from app.core.factories import settings
+from app.core.middlewares import (
+    AdaptiveConcurrency, Compression, ContentNegotiation, CustomSuccessHeader,
+    Deadline, LoaderScope, RequestMetrics, Tracing)
+from app.core.openapi import OpenAPIDocument
+from app.core.static import PrecompressedStaticFiles
+from app.core.warmup import warm_up
+from app.utils.batch import batch_response
+from app.utils.cache import cache_stats
+from app.utils.deadlines import DeadlineExceeded, gateway_timeout
+from app.utils.responses import FastJSONResponse, error_response
+from app.utils.singleflight import coalesce_stats
 from app.api.exceptions.generic_exception import CustomHTTPException
+from app.api.schema.batch_schema import BatchRequestSchema
 from app.api.controller.test_controller import router as test_router
 
-app = FastAPI()
+# /openapi.json is served from the pre-serialized document below
+app = FastAPI(openapi_url=None, default_response_class=FastJSONResponse)
+
+
+# registered before db.init_app: shutdown handlers run in order, and
+# buffered rows must be written before gino closes the pool
+@app.on_event("startup")
+async def start_write_behind():
+    await write_behind.start()
+
+
+@app.on_event("shutdown")
+async def flush_write_behind():
+    await write_behind.stop()
+
+
 db.init_app(app)
 app.include_router(test_router)
+app.mount(
+    "/static",
+    PrecompressedStaticFiles(
+        directory=os.path.join(os.path.dirname(__file__), "static"),
+        cache_control=settings.STATIC_CACHE_CONTROL),
+    name="static")
 
 
-class CustomSuccessHeader(BaseHTTPMiddleware):
-    async def dispatch(
-            self,
-            request: Request,
-            call_next: RequestResponseEndpoint) -> Response:
-        response = await call_next(request)
-        if response.headers["Content-Type"] == "application/json":
-            response.headers["Content-Type"] = "application/vnd+yobny.____________.success+json"
-        return response
+# many sub-requests in one call, answered together; see app.utils.batch
+@app.post("/batch")
+async def batch(request: Request, batch: BatchRequestSchema):
+    return await batch_response(request, batch.requests)
+
+
+@app.get("/pool-stats", include_in_schema=False)
+def pool_stats():
+    return pool_monitor.stats()
+
+
+@app.get("/limiter-stats", include_in_schema=False)
+def limiter_stats():
+    return limiter.stats()
+
+
+@app.get("/write-behind-stats", include_in_schema=False)
+def write_behind_stats():
+    return write_behind.stats()
+
+
+# Prometheus scrape target; exempt from auth
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return pool_metrics.response()
+
+
+@app.on_event("startup")
+async def start_pool_metrics():
+    if settings.METRICS_ENABLED:
+        await pool_metrics.start()
+
+
+@app.on_event("shutdown")
+async def stop_pool_metrics():
+    await pool_metrics.stop()
+
+
+@app.get("/tracing-stats", include_in_schema=False)
+def tracing_stats():
+    return tracer.exporter.stats()
+
+
+@app.on_event("startup")
+async def start_span_exporter():
+    if settings.TRACING_ENABLED:
+        await tracer.exporter.start()
+
+
+@app.on_event("shutdown")
+async def stop_span_exporter():
+    await tracer.exporter.stop()
+
+
+@app.get("/replica-stats", include_in_schema=False)
+def replica_stats():
+    return replicas.stats()
+
+
+@app.get("/cache-stats", include_in_schema=False)
+def get_cache_stats():
+    return {**cache_stats(), "invalidation": invalidator.stats()}
+
+
+@app.get("/coalesce-stats", include_in_schema=False)
+def get_coalesce_stats():
+    return coalesce_stats()
+
+
+@app.on_event("startup")
+async def listen_for_invalidations():
+    if settings.CACHE_INVALIDATION:
+        await invalidator.start()
+
+
+@app.on_event("shutdown")
+async def stop_listening_for_invalidations():
+    await invalidator.stop()
+
+
+# registered after db.init_app, so the primary is bound (and closed) first
+@app.on_event("startup")
+async def connect_replicas():
+    await replicas.connect()
+
+
+@app.on_event("shutdown")
+async def close_replicas():
+    await replicas.close()
+
+
+# runs after gino's startup handler has created the pool; uvicorn only
+# accepts traffic once every startup handler has finished
+@app.on_event("startup")
+async def warm_up_db_pool():
+    if settings.DB_WARM_UP:
+        await warm_up.run(
+            db, settings.DB_POOL_MIN_SIZE, prime=not settings.DB_PGBOUNCER)
+    else:
+        warm_up.ready = True
+
+
+@app.get("/ready", include_in_schema=False)
+def ready():
+    return JSONResponse(
+        status_code=200 if warm_up.ready else 503,
+        content={"ready": warm_up.ready})
 
 
 app.add_middleware(CustomSuccessHeader)
+app.add_middleware(LoaderScope)
+if settings.LIMITER_ENABLED:
+    # inside negotiation and CORS, so a shed request still gets a response
+    # the client can read
+    app.add_middleware(
+        AdaptiveConcurrency,
+        limiter=limiter,
+        retry_after=settings.LIMITER_RETRY_AFTER)
+app.add_middleware(
+    Deadline,
+    timeout=settings.REQUEST_TIMEOUT,
+    routes=settings.REQUEST_TIMEOUT_ROUTES)
+app.add_middleware(ContentNegotiation)
+app.add_middleware(
+    Compression,
+    minimum_size=settings.COMPRESSION_MIN_SIZE,
+    level=settings.COMPRESSION_LEVEL)
+if settings.METRICS_ENABLED:
+    app.add_middleware(RequestMetrics)
 
 
 @app.exception_handler(CustomHTTPException)
 async def http_exception_handler(request, exc):
-    from app.api.schema.generic_schema import GenericErrorResponseSchema
-    return JSONResponse(
-        status_code=exc.status_code,
-        headers=exc.headers,
-        content=jsonable_encoder(GenericErrorResponseSchema(
-            code=exc.status_code,
-            message=exc.message,
-            type=exc.type,
-            details=exc.details
-        )))
+    return error_response(exc)
+
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded_handler(request, exc):
+    return error_response(gateway_timeout())
 
 cors_origins = [i.strip() for i in settings.CORS_ORIGINS.split(",")]
 app.add_middleware(
@@ -201,6 +372,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+if settings.TRACING_ENABLED:
+    app.add_middleware(Tracing, tracer=tracer)
 
 
 @ app.get("/docs", include_in_schema=False)
@@ -231,9 +404,597 @@ def custom_openapi():
 
 
 app.openapi = custom_openapi
+openapi_document = OpenAPIDocument(path=settings.OPENAPI_SCHEMA_FILE)
+
+
+@app.on_event("startup")
+async def build_openapi_document():
+    openapi_document.load(app)
+
+
+@app.get("/openapi.json", include_in_schema=False)
+def openapi_json(request: Request):
+    return openapi_document.response(request)
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
 
+"""
+MIDDLEWARES = """
+import asyncio
+import time
+import zlib
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from app.api.exceptions.generic_exception import CustomHTTPException
+from app.core.limiter import AdaptiveLimiter
+from app.core.metrics import observe_request, route_template
+from app.core.tracing import TRACEPARENT, Tracer
+from app.core.tracing import reset as reset_span
+from app.core.tracing import set_current
+from app.utils.deadlines import (
+    TIMEOUT_HEADER, clear_deadline, gateway_timeout, parse_route_timeouts,
+    reset as reset_deadline, reset_timer, set_deadline, set_timer)
+from app.utils.headers import SERVICE_UNAVAILABLE_HEADER
+from app.utils.loader import close_scope, open_scope
+from app.utils.negotiation import negotiate, reset
+from app.utils.responses import error_response
+from app.utils.types import SERVICE_UNAVAILABLE_TYPE
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SUCCESS_MEDIA_TYPE = "application/vnd+yobny.____________.success+json"
+SUCCESS_MSGPACK_MEDIA_TYPE = "application/vnd+yobny.____________.success+msgpack"
+
+
+# Pure ASGI: only the "http.response.start" message is rewritten, the body
+# is forwarded as it is sent, without the extra task and memory stream of
+# BaseHTTPMiddleware.
+class CustomSuccessHeader:
+
+    def __init__(
+            self,
+            app: ASGIApp,
+            media_type: str = SUCCESS_MEDIA_TYPE,
+            msgpack_media_type: str = SUCCESS_MSGPACK_MEDIA_TYPE) -> None:
+        self.app = app
+        self.media_types = {
+            b"application/json": media_type.encode("latin-1"),
+            b"application/msgpack": msgpack_media_type.encode("latin-1"),
+        }
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                message["headers"] = [
+                    (key, self.media_types.get(value, value))
+                    if key == b"content-type"
+                    else (key, value)
+                    for key, value in message.get("headers", [])
+                ]
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+# Picks JSON or msgpack for the request from its Accept header; read by
+# utils.responses.FastJSONResponse while rendering
+class ContentNegotiation:
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = negotiate(Headers(scope=scope).get("accept", ""))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            reset(token)
+
+
+# A fresh set of utils.loader DataLoaders, and so of their cache, per request
+class LoaderScope:
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = open_scope()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            close_scope(token)
+
+
+# Over the limiter's cap a request gets a 503 right away, rather than
+# queueing for a database connection until the client gives up. Time to
+# the response start is the latency sample.
+class AdaptiveConcurrency:
+
+    def __init__(
+            self, app: ASGIApp, limiter: AdaptiveLimiter,
+            retry_after: int = 1) -> None:
+        self.app = app
+        self.limiter = limiter
+        self.retry_after = retry_after
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if not self.limiter.acquire(self.limiter.priority(scope["path"])):
+            response = error_response(CustomHTTPException(
+                status_code=503,
+                message="Service Unavailable",
+                details="Too many requests in flight, retry later",
+                headers={
+                    **SERVICE_UNAVAILABLE_HEADER,
+                    "Retry-After": str(self.retry_after)},
+                type=SERVICE_UNAVAILABLE_TYPE))
+            await response(scope, receive, send)
+            return
+        start = time.perf_counter()
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                self.limiter.sample(time.perf_counter() - start)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.limiter.release()
+
+
+# Gives each request a deadline (app.utils.deadlines) and cancels it once
+# the deadline passes, answering 504, unless the response has started by
+# then. Database statements and pool waits are capped to the time left, see
+# core.pool, until the body is sent; background tasks run uncapped, and
+# streamed exports opt out early with clear_deadline().
+class Deadline:
+
+    def __init__(self, app: ASGIApp, timeout: float = 30.0, routes=()) -> None:
+        self.app = app
+        self.timeout = timeout
+        self.routes = parse_route_timeouts(routes)
+
+    def timeout_for(self, scope: Scope) -> float:
+        timeout = self.timeout
+        for prefix, seconds in self.routes:
+            if scope["path"].startswith(prefix):
+                timeout = seconds
+                break
+        requested = Headers(scope=scope).get(TIMEOUT_HEADER)
+        if requested:
+            try:
+                requested = float(requested)
+            except ValueError:
+                requested = 0.0
+            if requested > 0:
+                timeout = min(timeout, requested) if timeout else requested
+        return timeout
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        timeout = self.timeout_for(scope) if scope["type"] == "http" else 0
+        if not timeout:
+            await self.app(scope, receive, send)
+            return
+        started = False
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+                # too late for a 504, and a body cut short is worse
+                timer.cancel()
+            elif message["type"] == "http.response.body" and not message.get(
+                    "more_body", False):
+                # the response's background tasks run next, in this call
+                clear_deadline()
+            await send(message)
+
+        task = asyncio.current_task()
+        expired = False
+
+        def expire() -> None:
+            nonlocal expired
+            expired = True
+            task.cancel()
+
+        # a timer on the request's own task: asyncio.wait_for would run every
+        # request in a task of its own
+        timer = asyncio.get_event_loop().call_later(timeout, expire)
+        timer_token = set_timer(timer)
+        token = set_deadline(timeout)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except asyncio.CancelledError:
+            if not expired:
+                raise
+            if not started:
+                await error_response(gateway_timeout())(scope, receive, send)
+        finally:
+            timer.cancel()
+            reset_deadline(token)
+            reset_timer(timer_token)
+
+
+# Request count and latency per route template and status class, see
+# app.core.metrics. Outermost but for CORS, so time spent shedding,
+# negotiating and compressing is counted too.
+class RequestMetrics:
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        # what ServerErrorMiddleware answers if nothing was sent
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            observe_request(scope, status, time.perf_counter() - start)
+
+
+# Root span of each request (app.core.tracing), in the caller's trace when
+# it sent a traceparent header. Outermost, so the spans below it leave the
+# time spent in the other middlewares.
+class Tracing:
+
+    def __init__(self, app: ASGIApp, tracer: Tracer) -> None:
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        root = self.tracer.start(
+            scope["method"], Headers(scope=scope).get(TRACEPARENT),
+            method=scope["method"], path=scope["path"])
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        token = set_current(root)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except asyncio.CancelledError:
+            root.status = "cancelled"
+            raise
+        except Exception as e:
+            root.status = "error"
+            root.set("error", repr(e)[:200])
+            raise
+        finally:
+            reset_span(token)
+            if root.sampled:
+                route = route_template(scope)
+                root.name = "%s %s" % (scope["method"], route)
+                root.set("route", route)
+                root.set("status_code", status)
+                if status >= 500:
+                    root.status = "error"
+                root.finish()
+
+
+# already compressed, compressing again only costs CPU
+SKIP_COMPRESSION_TYPES = (
+    "image/", "video/", "audio/", "font/woff", "application/zip",
+    "application/gzip", "application/x-gzip", "application/x-brotli",
+    "application/pdf", "application/octet-stream",
+)
+
+
+def accepted_encodings(accept_encoding: str) -> set:
+    accepted = set()
+    for item in accept_encoding.lower().split(","):
+        coding, _, param = item.partition(";")
+        param = param.strip()
+        if param.startswith("q="):
+            try:
+                if float(param[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip())
+    return accepted
+
+
+def choose_encoding(accept_encoding: str, brotli_available: bool = True):
+    # "br" over "gzip" when both are acceptable
+    accepted = accepted_encodings(accept_encoding)
+    if brotli_available and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+class Compression:
+
+    def __init__(
+            self,
+            app: ASGIApp,
+            minimum_size: int = 500,
+            level: int = 6,
+            skip_types=SKIP_COMPRESSION_TYPES) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+        self.skip_types = skip_types
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        encoding = None
+        if scope["type"] == "http" and scope["method"] != "HEAD":
+            encoding = choose_encoding(
+                Headers(scope=scope).get("accept-encoding", ""),
+                brotli is not None)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, _Compressor(self, encoding, send).send)
+
+    def should_compress(self, headers: MutableHeaders, status: int,
+                        body: bytes, more_body: bool) -> bool:
+        if status < 200 or status in (204, 304) or "content-encoding" in headers:
+            return False
+        if "no-transform" in headers.get("cache-control", ""):
+            return False
+        content_type = headers.get("content-type", "").lower()
+        if content_type.startswith(self.skip_types):
+            return content_type.startswith("image/svg")
+        return more_body or len(body) >= self.minimum_size
+
+
+class _Compressor:
+    # one per response: holds "http.response.start" until the first body
+    # message decides whether the response is compressed
+
+    def __init__(self, middleware: Compression, encoding: str, send: Send) -> None:
+        self.middleware = middleware
+        self.encoding = encoding
+        self._send = send
+        self.start = None
+        self.compressor = None
+        self.passthrough = False
+
+    def compress(self, data: bytes, more_body: bool) -> bytes:
+        if self.encoding == "br":
+            data = self.compressor.process(data)
+            return data + (self.compressor.flush() if more_body
+                           else self.compressor.finish())
+        # sync flush, so streamed chunks reach the client as they are sent
+        return self.compressor.compress(data) + self.compressor.flush(
+            zlib.Z_SYNC_FLUSH if more_body else zlib.Z_FINISH)
+
+    async def send(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self._send(message)
+            return
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.compressor is None:
+            # a copy: the list belongs to the Response, which may be sent again
+            headers = MutableHeaders(raw=list(self.start["headers"]))
+            self.start["headers"] = headers.raw
+            if not self.middleware.should_compress(
+                    headers, self.start["status"], body, more_body):
+                self.passthrough = True
+                await self._send(self.start)
+                await self._send(message)
+                return
+            if self.encoding == "br":
+                self.compressor = brotli.Compressor(
+                    quality=min(self.middleware.level, 11))
+            else:
+                self.compressor = zlib.compressobj(
+                    self.middleware.level, zlib.DEFLATED, 31)
+            headers["content-encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            etag = headers.get("etag")
+            if etag and not etag.startswith("W/"):
+                # the compressed body is a different representation
+                headers["etag"] = "W/" + etag
+            del headers["content-length"]
+            body = self.compress(body, more_body)
+            if not more_body:
+                headers["content-length"] = str(len(body))
+            await self._send(self.start)
+        else:
+            body = self.compress(body, more_body)
+        await self._send(
+            {"type": "http.response.body", "body": body, "more_body": more_body})
+
+"""
+OPENAPI = """
+import hashlib
+import json
+import os
+import sys
+import zlib
+from fastapi import FastAPI
+from starlette.requests import Request
+from starlette.responses import Response
+
+OPENAPI_MEDIA_TYPE = "application/json"
+# the document never changes for the lifetime of a process; clients keep
+# their copy and revalidate it with If-None-Match
+OPENAPI_CACHE_CONTROL = "public, no-cache"
+
+
+def serialize(schema: dict) -> bytes:
+    return json.dumps(
+        schema,
+        ensure_ascii=False,
+        separators=(",", ":")).encode("utf-8")
+
+
+def gzip_bytes(body: bytes) -> bytes:
+    # wbits=31 writes a gzip container with a zero mtime, so the compressed
+    # variant (and its ETag) is stable across workers
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate in (etag, "*"):
+            return True
+    return False
+
+
+class OpenAPIDocument:
+
+    def __init__(self, path: str = "") -> None:
+        self.path = path
+        self.body = b""
+        self.gzip_body = b""
+        self.etag = ""
+        self.gzip_etag = ""
+
+    def load(self, app: FastAPI) -> None:
+        if self.path and os.path.exists(self.path):
+            with open(self.path, "rb") as schema_file:
+                body = schema_file.read()
+        else:
+            body = serialize(app.openapi())
+        digest = hashlib.sha256(body).hexdigest()
+        self.body = body
+        self.gzip_body = gzip_bytes(body)
+        self.etag = '"%s"' % digest
+        self.gzip_etag = '"%s-gzip"' % digest
+
+    def response(self, request: Request) -> Response:
+        if not self.body:
+            self.load(request.app)
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            body, etag = self.gzip_body, self.gzip_etag
+            headers = {"Content-Encoding": "gzip"}
+        else:
+            body, etag = self.body, self.etag
+            headers = {}
+        headers["ETag"] = etag
+        headers["Cache-Control"] = OPENAPI_CACHE_CONTROL
+        headers["Vary"] = "Accept-Encoding"
+        if etag_matches(request.headers.get("if-none-match", ""), etag):
+            return Response(status_code=304, headers=headers)
+        return Response(body, media_type=OPENAPI_MEDIA_TYPE, headers=headers)
+
+
+if __name__ == "__main__":
+    # doit openapi: write the schema ahead of time
+    from app.main import app
+    with open(sys.argv[1], "wb") as output:
+        output.write(serialize(app.openapi()))
+
+"""
+WARMUP = """
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Registry of hot queries, primed on every pooled connection before the
+# worker reports ready. Register cheap, representative statements, e.g.
+#     warm_up.register(Test.query.where(Test.id == db.bindparam("id")), id=uuid4())
+#     warm_up.register("SELECT count(*) FROM test WHERE created > $1", datetime.utcnow())
+class WarmUp:
+
+    def __init__(self) -> None:
+        self.queries = []
+        self.ready = False
+
+    def register(self, query, *args, **params):
+        self.queries.append((query, args, params))
+        return query
+
+    def compile(self, dialect):
+        statements = []
+        for query, args, params in self.queries:
+            if isinstance(query, str):
+                statements.append((query, args))
+                continue
+            # the same text Gino sends, so the statement cache entry is reused
+            compiled = query.compile(dialect=dialect)
+            values = compiled.construct_params(params)
+            statements.append((
+                str(compiled),
+                tuple(values[name] for name in compiled.positiontup or ())))
+        return statements
+
+    async def prime(self, conn, statements) -> None:
+        for sql, args in statements:
+            # prepared statements outlive the rollback; any writes do not
+            transaction = conn.transaction()
+            await transaction.start()
+            try:
+                await conn.fetch(sql, *args)
+            except Exception:
+                logger.exception("Warm-up query failed: %s", sql)
+            finally:
+                await transaction.rollback()
+
+    async def run(self, db, connections: int, prime: bool = True) -> None:
+        pool = db.bind.raw_pool
+        statements = self.compile(db.bind.dialect) if prime else []
+        acquired = await asyncio.gather(
+            *(pool.acquire() for _ in range(connections)),
+            return_exceptions=True)
+        try:
+            for conn in acquired:
+                if isinstance(conn, BaseException):
+                    raise conn
+            await asyncio.gather(
+                *(self.prime(conn, statements) for conn in acquired))
+        finally:
+            await asyncio.gather(*(
+                pool.release(conn) for conn in acquired
+                if not isinstance(conn, BaseException)))
+        self.ready = True
+        logger.info(
+            "Warmed %d connections with %d statements",
+            len(acquired), len(statements))
+
+
+warm_up = WarmUp()
+
 """
 GENERIC_EXCEPTION = """
 from typing import Any, Dict, Optional
@@ -282,24 +1043,53 @@ class CustomHTTPException(StarletteHTTPException):
 
 """
 HELPER = """
+import asyncio
 from typing import Any, Optional, Tuple
 from humps import camelize
-from functools import wraps
+from functools import lru_cache, wraps
 from app.api.exceptions.generic_exception import CustomHTTPException
 from app.utils.types import *
 from app.utils.headers import *
 from app.api.exceptions.generic_exception import BadRequestException, NotFoundException
+from app.core.tracing import span
+from app.utils.deadlines import DeadlineExceeded, gateway_timeout
 
 
-def to_camel(string):
+# keys seen at runtime are a small, repeating set; bounded in case a payload
+# uses user supplied keys
+CAMEL_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=CAMEL_CACHE_SIZE)
+def _camel_key(string):
     return camelize(string)
 
 
+def to_camel(string):
+    if isinstance(string, str):
+        return _camel_key(string)
+    return camelize_keys(string)
+
+
+def camelize_keys(data):
+    # recursive, like humps.camelize, but one memo lookup per key
+    if isinstance(data, dict):
+        return {
+            _camel_key(key) if isinstance(key, str) else key: camelize_keys(value)
+            for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [camelize_keys(item) for item in data]
+    if hasattr(data, "to_camel_dict"):
+        return data.to_camel_dict()
+    return data
+
+
 def exception_handler(f):
     @wraps(f)
     async def decorator(*args, **kwargs):
         try:
-            return await f(*args, **kwargs)
+            with span("handler", function=f.__qualname__):
+                return await f(*args, **kwargs)
         except NotFoundException as e:
             raise CustomHTTPException(
                 status_code=404,
@@ -314,6 +1104,12 @@ def exception_handler(f):
                 details=str(e.msg),
                 headers=BAD_REQUEST_HEADER,
                 type=BAD_REQUEST_TYPE)
+        except DeadlineExceeded:
+            raise gateway_timeout()
+        except asyncio.CancelledError:
+            # an Exception before python 3.8; the request is being cancelled,
+            # e.g. by its deadline, there is no one to answer
+            raise
         except Exception as e:
             # e can be empty sometimes
             if str(e) in ["", None, " ", False]:
@@ -360,10 +1156,102 @@ class BaseConfig:
         "SQLALCHEMY_TRACK_MODIFICATIONS", cast=bool, default=False)
     LOGGER_NAME = "%s_log" % project_name
     LOG_FILENAME = "/var/tmp/app.%s.log" % project_name
+    OPENAPI_SCHEMA_FILE = config("OPENAPI_SCHEMA_FILE", cast=str, default="")
     CORS_ORIGINS = config("CORS_HOSTS", default="*")
+    COMPRESSION_MIN_SIZE = config("COMPRESSION_MIN_SIZE", cast=int, default=500)
+    COMPRESSION_LEVEL = config("COMPRESSION_LEVEL", cast=int, default=6)
+    STATIC_CACHE_CONTROL = config(
+        "STATIC_CACHE_CONTROL", cast=str,
+        default="public, max-age=31536000, immutable")
     DEBUG = config("DEBUG", cast=bool, default=True)
     TESTING = config("TESTING", cast=bool, default=False)
 
+    # Database pool
+    SSL_CERT_FILE = config("SSL_CERT_FILE", cast=str, default=None)
+    DB_POOL_MIN_SIZE = config("DB_POOL_MIN_SIZE", cast=int, default=3)
+    DB_POOL_MAX_SIZE = config("DB_POOL_MAX_SIZE", cast=int, default=20)
+    DB_POOL_MAX_INACTIVE_LIFETIME = config(
+        "DB_POOL_MAX_INACTIVE_LIFETIME", cast=float, default=300.0)
+    DB_STATEMENT_CACHE_SIZE = config(
+        "DB_STATEMENT_CACHE_SIZE", cast=int, default=100)
+    DB_COMMAND_TIMEOUT = config("DB_COMMAND_TIMEOUT", cast=float, default=None)
+    DB_PGBOUNCER = config("DB_PGBOUNCER", cast=bool, default=False)
+    DB_WARM_UP = config("DB_WARM_UP", cast=bool, default=True)
+    # primary keys of SurrogatePK models: 4 random, 7 time ordered
+    DB_UUID_VERSION = config("DB_UUID_VERSION", cast=int, default=4)
+
+    # Model.create_buffered: rows per insert, seconds a row may wait,
+    # queued rows before callers wait, and seconds shutdown waits for them
+    WRITE_BEHIND_MAX_BATCH = config(
+        "WRITE_BEHIND_MAX_BATCH", cast=int, default=1000)
+    WRITE_BEHIND_FLUSH_INTERVAL = config(
+        "WRITE_BEHIND_FLUSH_INTERVAL", cast=float, default=0.5)
+    WRITE_BEHIND_MAX_QUEUE = config(
+        "WRITE_BEHIND_MAX_QUEUE", cast=int, default=10000)
+    WRITE_BEHIND_SHUTDOWN_TIMEOUT = config(
+        "WRITE_BEHIND_SHUTDOWN_TIMEOUT", cast=float, default=10.0)
+
+    # Adaptive in-flight request cap, see app.core.limiter; priorities are
+    # "path-prefix=critical|high|normal|low" items. Off by default: it sheds
+    # normal requests past 80% of the limit, so size LIMITER_INITIAL to the
+    # concurrency a worker is expected to take before turning it on
+    LIMITER_ENABLED = config("LIMITER_ENABLED", cast=bool, default=False)
+    LIMITER_INITIAL = config("LIMITER_INITIAL", cast=int, default=20)
+    LIMITER_MIN = config("LIMITER_MIN", cast=int, default=5)
+    LIMITER_MAX = config("LIMITER_MAX", cast=int, default=200)
+    LIMITER_BACKOFF = config("LIMITER_BACKOFF", cast=float, default=0.9)
+    LIMITER_TOLERANCE = config("LIMITER_TOLERANCE", cast=float, default=2.0)
+    LIMITER_RETRY_AFTER = config("LIMITER_RETRY_AFTER", cast=int, default=1)
+    LIMITER_ROUTE_PRIORITIES = config(
+        "LIMITER_ROUTE_PRIORITIES", cast=CommaSeparatedStrings,
+        default=(
+            "/ready=critical, /pool-stats=critical, /limiter-stats=critical,"
+            "/metrics=critical"))
+
+    # Request deadlines in seconds, 0 for none; per route as
+    # "path-prefix=seconds" items. stream_query responses have none
+    REQUEST_TIMEOUT = config("REQUEST_TIMEOUT", cast=float, default=30.0)
+    REQUEST_TIMEOUT_ROUTES = config(
+        "REQUEST_TIMEOUT_ROUTES", cast=CommaSeparatedStrings, default="")
+
+    # Prometheus metrics on /metrics, see app.core.metrics for running
+    # several workers; pool gauges are refreshed every interval seconds
+    METRICS_ENABLED = config("METRICS_ENABLED", cast=bool, default=True)
+    METRICS_POOL_INTERVAL = config(
+        "METRICS_POOL_INTERVAL", cast=float, default=5.0)
+
+    # Tracing, see app.core.tracing: this share of requests is traced; a
+    # caller's sampled flag is followed as is only with TRACING_TRUST_PARENT,
+    # for services behind a gateway of ours. Spans are written as JSON lines
+    # to TRACING_FILE, "-" for stdout; nothing rotates a file
+    TRACING_ENABLED = config("TRACING_ENABLED", cast=bool, default=False)
+    TRACING_SAMPLE_RATIO = config(
+        "TRACING_SAMPLE_RATIO", cast=float, default=0.05)
+    TRACING_TRUST_PARENT = config(
+        "TRACING_TRUST_PARENT", cast=bool, default=False)
+    TRACING_FILE = config("TRACING_FILE", cast=str, default="-")
+
+    # Read replicas
+    DATABASE_REPLICA_URLS = config(
+        "DATABASE_REPLICA_URLS", cast=CommaSeparatedStrings, default="")
+    DB_REPLICA_HEALTH_INTERVAL = config(
+        "DB_REPLICA_HEALTH_INTERVAL", cast=float, default=5.0)
+    DB_REPLICA_MAX_LAG = config("DB_REPLICA_MAX_LAG", cast=float, default=10.0)
+
+    # Cache invalidation over LISTEN/NOTIFY; LISTEN needs a session, so point
+    # DATABASE_LISTEN_URL past pgbouncer in transaction mode
+    CACHE_INVALIDATION = config("CACHE_INVALIDATION", cast=bool, default=True)
+    CACHE_INVALIDATION_CHANNEL = config(
+        "CACHE_INVALIDATION_CHANNEL", cast=str, default="cache_invalidation")
+    CACHE_INVALIDATION_KEEPALIVE = config(
+        "CACHE_INVALIDATION_KEEPALIVE", cast=float, default=10.0)
+    DATABASE_LISTEN_URL = config("DATABASE_LISTEN_URL", cast=str, default="")
+
+    # /batch: items per call, and how many of its reads run at once
+    BATCH_MAX_REQUESTS = config("BATCH_MAX_REQUESTS", cast=int, default=50)
+    BATCH_MAX_CONCURRENCY = config(
+        "BATCH_MAX_CONCURRENCY", cast=int, default=10)
+
     # Authentication
     AUTH_IDENTITY_VERIFY_URL = config(
         "AUTH_IDENTITY_VERIFY_URL", cast=str, default="")
@@ -374,7 +1262,7 @@ class BaseConfig:
     AUTH_EXEMPTED_AUTH_ROUTES = config(
         "AUTH_EXEMPTED_AUTH_ROUTES", cast=CommaSeparatedStrings,
         default=(
-            "/docs, /openapi.json,"
+            "/docs, /openapi.json, /ready, /metrics,"
             "/static/css/styles.css,"
         ))
 
@@ -430,42 +1318,1542 @@ else:
     raise SystemExit(
         "settings for app not exported. example:  ```export settings=dev```")
 
-"""
+"""
+
+
+DB_SETUP = """
+import logging
+from datetime import datetime
+from asyncpg.exceptions import DataError, InternalClientError
+from gino.crud import DEFAULT, UpdateRequest
+# add created,updated columns to model
+from sqlalchemy_utils import UUIDType, Timestamp
+from app.core.extensions import db, invalidator, write_behind
+from app.core.replicas import mark_write
+from app.utils.helper import to_camel
+from app.utils.ids import uuid4_batch, uuid_generators  # noqa
+from app.utils.loader import loader
+
+logger = logging.getLogger(__name__)
+
+# postgres caps a statement at 32767 bind parameters
+MAX_BIND_PARAMS = 32767
+
+# __tablename__ -> TimePartitioned model, for app.core.partitions
+partitioned_models = {}
+
+
+class SurrogatePK(object):
+    __table_args__ = {"extend_existing": True}
+
+    id = db.Column(UUIDType(binary=False), primary_key=True)
+    # 7 for time ordered ids on insert heavy tables, 4 for random ones;
+    # None follows settings.DB_UUID_VERSION
+    uuid_version = None
+
+
+class SurrogateAudit(object):
+
+    __table_args__ = {"extend_existing": True}
+
+    _created = db.Column(db.Time(), nullable=True)
+    _modified = db.Column(db.Time(), nullable=True)
+    _created_by = db.Column(db.String(), nullable=True)
+    _modified_by = db.Column(db.String(), nullable=True)
+
+
+# Range partitioned on `created`, a partition per __partition_interval__
+# ("day", "week" or "month"). Postgres needs the partition key in the
+# primary key, so it is (id, created): look rows up with Model.load(id) or
+# a query, and filter on `created` so postgres only scans the partitions
+# in range. `doit partitions` makes upcoming partitions and detaches expired
+# ones, see app.core.partitions.
+#
+#     class Event(TimePartitioned, Model):
+#         __tablename__ = "event"
+#         __partition_retention__ = 12
+class TimePartitioned(object):
+    __table_args__ = {
+        "extend_existing": True,
+        "postgresql_partition_by": "RANGE (created)",
+    }
+    __partition_interval__ = "month"
+    # partitions made ahead of the current one
+    __partition_premake__ = 3
+    # intervals kept attached; None keeps them all
+    __partition_retention__ = None
+
+    id = db.Column(UUIDType(binary=False), nullable=False)
+    created = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    @db.declared_attr
+    def _partition_key(cls):
+        # id first, so lookups by id use the primary key index
+        return db.PrimaryKeyConstraint("id", "created")
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # a subclass's own __table_args__ keeps the partitioning
+        args = cls.__dict__.get("__table_args__")
+        if isinstance(args, dict):
+            cls.__table_args__ = {**TimePartitioned.__table_args__, **args}
+        elif isinstance(args, tuple):
+            options = args[-1] if args and isinstance(args[-1], dict) else {}
+            items = args[:-1] if options else args
+            cls.__table_args__ = items + (
+                {**TimePartitioned.__table_args__, **options},)
+        if "__tablename__" in cls.__dict__:
+            partitioned_models[cls.__tablename__] = cls
+
+
+class ModelUpdateRequest(UpdateRequest):
+
+    async def apply(self, bind=None, timeout=DEFAULT):
+        # gino skips the ORM before_update event Timestamp relies on, and
+        # conditional GETs compare `updated`
+        if isinstance(self._instance, Timestamp) and "updated" not in self._values:
+            self.update(updated=datetime.utcnow())
+        await super().apply(bind=bind, timeout=timeout)
+        await invalidator.publish(self._instance.cache_tags())
+        return self
+
+
+class Model(Timestamp, SurrogatePK, SurrogateAudit, db.Model):
+    __abstract__ = True
+
+    # writes through create/update/delete/bulk_create invalidate cache
+    # entries tagged with the table or the row
+    _update_request_cls = ModelUpdateRequest
+
+    @classmethod
+    async def load(cls, id):
+        # get(), batched with the request's other loads and cached for it
+        return await loader(cls).load(id)
+
+    def cache_tags(self):
+        table = self.__table__.name
+        return [table, "%s:%s" % (table, self.id)]
+
+    @classmethod
+    def alias_map(cls):
+        # attribute -> camelCase alias, built once per model class
+        aliases = cls.__dict__.get("_alias_map")
+        if aliases is None:
+            aliases = {key: to_camel(key) for key in cls._column_name_map}
+            cls._alias_map = aliases
+        return aliases
+
+    @classmethod
+    def python_defaults(cls):
+        # attribute -> Column default= that SQLAlchemy applies on insert;
+        # COPY only sees server defaults, so bulk_create fills these itself
+        defaults = cls.__dict__.get("_python_defaults")
+        if defaults is None:
+            defaults = {}
+            for key, name in cls._column_name_map.items():
+                default = cls.__table__.columns[name].default
+                if default is not None and (default.is_scalar or default.is_callable):
+                    defaults[key] = default
+            cls._python_defaults = defaults
+        return defaults
+
+    def to_camel_dict(self):
+        aliases = self.alias_map()
+        return {
+            aliases.get(key) or to_camel(key): value
+            for key, value in self.to_dict().items()}
+
+    @classmethod
+    async def create(cls, **kwargs):
+        if issubclass(cls, SurrogatePK):
+            if not kwargs.get("id"):
+                kwargs["id"] = uuid_generators(cls.uuid_version)[0]()
+        instance = await cls(**kwargs)._create()
+        await invalidator.publish(instance.cache_tags())
+        return instance
+
+    @classmethod
+    async def create_buffered(cls, **kwargs):
+        # queued for a later bulk_create, see app.core.writebehind; the row
+        # gets its id and timestamps when written
+        unknown = set(kwargs) - set(cls._column_name_map)
+        if unknown:
+            raise TypeError("%s has no columns %s" % (
+                cls.__name__, ", ".join(sorted(unknown))))
+        await write_behind.add(cls, kwargs)
+
+    async def _delete(self, bind=None, timeout=DEFAULT):
+        status = await super()._delete(bind=bind, timeout=timeout)
+        await invalidator.publish(self.cache_tags())
+        return status
+
+    @classmethod
+    async def bulk_create(cls, rows, created_by=None, use_copy=True):
+        rows = [dict(row) for row in rows]
+        if not rows:
+            return rows
+        now = datetime.utcnow()
+        defaults = {}
+        if issubclass(cls, Timestamp):
+            defaults["created"] = now
+            defaults["updated"] = now
+        if issubclass(cls, SurrogateAudit):
+            defaults["_created"] = now.time()
+            defaults["_modified"] = now.time()
+            if created_by is not None:
+                defaults["_created_by"] = created_by
+                defaults["_modified_by"] = created_by
+        ids = []
+        if issubclass(cls, SurrogatePK):
+            ids = uuid_generators(cls.uuid_version)[1](len(rows))
+        python_defaults = cls.python_defaults()
+        groups = {}
+        for index, row in enumerate(rows):
+            for key, value in defaults.items():
+                row.setdefault(key, value)
+            if ids and not row.get("id"):
+                row["id"] = ids[index]
+            for key, default in python_defaults.items():
+                if key not in row:
+                    row[key] = default.arg if default.is_scalar else default.arg(None)
+            # a column a row leaves out gets its server default, not NULL,
+            # so only rows setting the same columns are written together
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+
+        table = cls.__table__
+        # goes through db.transaction, not the replica router; all or none of
+        # the rows are written, so a failed call can be retried as a whole
+        mark_write()
+        async with db.transaction() as tx:
+            conn = tx.connection
+            for keys, group in groups.items():
+                columns = [table.columns[cls._column_name_map[key]] for key in keys]
+                if not (use_copy and await cls._try_copy(conn, group, keys, columns)):
+                    await cls._insert_values(conn, group, keys, columns)
+            await invalidator.publish([table.name])
+        return rows
+
+    @classmethod
+    async def _try_copy(cls, conn, rows, keys, columns):
+        records = cls._copy_records(conn.dialect, rows, keys, columns)
+        raw_conn = await conn.get_raw_connection()
+        try:
+            # savepoint, so a rejected COPY leaves the outer transaction
+            # usable for the fallback
+            async with conn.transaction():
+                await raw_conn.copy_records_to_table(
+                    cls.__table__.name,
+                    records=records,
+                    columns=[column.name for column in columns],
+                    schema_name=cls.__table__.schema)
+        except InternalClientError as e:
+            # a column type without a binary encoder
+            logger.info("COPY into %s unsupported, using INSERT: %s",
+                        cls.__table__.name, e)
+            return False
+        except (DataError, TypeError, ValueError) as e:
+            # refused by the server, or by asyncpg's binary encoders, which
+            # do not adapt values the way INSERT parameters do
+            logger.warning("COPY into %s rejected, using INSERT: %s",
+                           cls.__table__.name, e)
+            return False
+        return True
+
+    @staticmethod
+    def _copy_records(dialect, rows, keys, columns):
+        # COPY skips SQLAlchemy, so apply the column type bind processors here
+        processors = [
+            column.type.dialect_impl(dialect).bind_processor(dialect)
+            for column in columns]
+        return [
+            tuple(
+                processor(row[key]) if processor else row[key]
+                for key, processor in zip(keys, processors))
+            for row in rows]
+
+    @classmethod
+    async def _insert_values(cls, conn, rows, keys, columns):
+        names = [column.name for column in columns]
+        chunk_size = max(1, MAX_BIND_PARAMS // len(names))
+        for start in range(0, len(rows), chunk_size):
+            values = [
+                {name: row[key] for key, name in zip(keys, names)}
+                for row in rows[start:start + chunk_size]]
+            await conn.status(cls.__table__.insert().values(values))
+
+"""
+UTIL_PAGINATION = """
+import base64
+import json
+from datetime import datetime
+from typing import Any, List, NamedTuple, Optional
+from uuid import UUID
+from sqlalchemy import literal, tuple_
+from app.api.exceptions.generic_exception import BadRequestException
+from app.api.schema.generic_schema import SuccessResponseSchema
+from app.utils.responses import envelope_response
+from app.utils.types import PARTIAL_CONTENT_TYPE
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Seek pagination over (created, id). Give paginated models a matching index
+# so every page is an index range scan, whatever its depth:
+#     _created_id_idx = db.Index("ix_<table>_created_id", "created", "id")
+
+
+class Page(NamedTuple):
+    items: List[Any]
+    next_cursor: Optional[str]
+    limit: int
+
+
+def encode_cursor(created: datetime, id: Any) -> str:
+    raw = json.dumps([created.isoformat(), str(id)], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created, id = json.loads(base64.urlsafe_b64decode(padded))
+        if not isinstance(created, str) or not isinstance(id, str):
+            raise ValueError(cursor)
+        return datetime.fromisoformat(created), UUID(id)
+    except (ValueError, TypeError):
+        raise BadRequestException("Invalid pagination cursor")
+
+
+async def paginate(model, *clauses, cursor=None, limit=DEFAULT_PAGE_SIZE,
+                   descending=False):
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    key = tuple_(model.created, model.id)
+    query = model.query
+    for clause in clauses:
+        query = query.where(clause)
+    if cursor:
+        created, id = decode_cursor(cursor)
+        position = tuple_(
+            literal(created, model.created.type),
+            literal(id, model.id.type))
+        query = query.where(key < position if descending else key > position)
+    if descending:
+        query = query.order_by(model.created.desc(), model.id.desc())
+    else:
+        query = query.order_by(model.created, model.id)
+    items = await query.limit(limit + 1).gino.all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1].created, items[-1].id)
+    return Page(items, next_cursor, limit)
+
+
+def partial_content(page: Page, message: str = "Partial Content"):
+    return envelope_response(
+        SuccessResponseSchema,
+        status_code=206,
+        type=PARTIAL_CONTENT_TYPE,
+        message=message,
+        details={
+            "items": [item.to_dict() for item in page.items],
+            "nextCursor": page.next_cursor,
+            "limit": page.limit,
+        })
+
+"""
+UTIL_STREAMING = """
+import json
+from datetime import date, datetime, time
+from typing import Any, Callable, Optional
+from starlette.responses import StreamingResponse
+from app.core.extensions import db
+from app.utils.deadlines import clear_deadline
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+JSON_MEDIA_TYPE = "application/json"
+EXPORT_CHUNK_SIZE = 500
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
+    return str(obj)
+
+
+def _to_dict(row: Any) -> dict:
+    return row.to_dict() if hasattr(row, "to_dict") else dict(row)
+
+
+def _dumps(row: Any) -> str:
+    return json.dumps(row, default=_default, separators=(",", ":"))
+
+
+async def iterate_chunks(query, chunk_size: int = EXPORT_CHUNK_SIZE):
+    # server-side cursor: it only lives inside a transaction, and at most
+    # chunk_size rows are held in memory at a time
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            cursor = await conn.iterate(query)
+            while True:
+                rows = await cursor.many(chunk_size)
+                if not rows:
+                    return
+                yield rows
+
+
+async def _ndjson(query, serialize, chunk_size):
+    async for rows in iterate_chunks(query, chunk_size):
+        yield "".join(
+            _dumps(serialize(row)) + "\\n" for row in rows).encode("utf-8")
+
+
+async def _json_array(query, serialize, chunk_size):
+    yield b"["
+    separator = ""
+    async for rows in iterate_chunks(query, chunk_size):
+        yield (separator + ",".join(
+            _dumps(serialize(row)) for row in rows)).encode("utf-8")
+        separator = ","
+    yield b"]"
+
+
+# Starlette cancels the body iterator when the client disconnects; the
+# cancellation unwinds iterate_chunks, which rolls back the cursor's
+# transaction and returns the connection to the pool. An export may take
+# longer than the request deadline: once sending has started, cancelling it
+# could only truncate the body, so it has no deadline.
+def stream_query(
+        query,
+        format: str = "ndjson",
+        serialize: Optional[Callable[[Any], Any]] = None,
+        chunk_size: int = EXPORT_CHUNK_SIZE,
+        headers: Optional[dict] = None) -> StreamingResponse:
+    clear_deadline()
+    serialize = serialize or _to_dict
+    if format == "ndjson":
+        body = _ndjson(query, serialize, chunk_size)
+        media_type = NDJSON_MEDIA_TYPE
+    else:
+        body = _json_array(query, serialize, chunk_size)
+        media_type = JSON_MEDIA_TYPE
+    return StreamingResponse(body, media_type=media_type, headers=headers)
+
+"""
+UTIL_CACHE = """
+import asyncio
+from functools import wraps
+from cachetools import TTLCache
+from cachetools.keys import hashkey
+
+_MISSING = object()
+
+# every cache created by @cached, by name
+caches = {}
+
+
+class AsyncTTLCache:
+
+    def __init__(self, name, ttl, maxsize):
+        self.name = name
+        self.ttl = ttl
+        self.data = TTLCache(maxsize=maxsize, ttl=ttl)
+        # key -> tags, for invalidate_tags(); pruned of evicted keys as it grows
+        self.key_tags = {}
+        # key -> [lock, users]; dropped once nobody waits on the key
+        self.locks = {}
+        # bumped by invalidation, so a computation that started before it
+        # does not store its now stale result
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    async def get_or_compute(self, key, compute, tags=None):
+        value = self.data.get(key, _MISSING)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+        entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                # filled while we waited for the lock
+                value = self.data.get(key, _MISSING)
+                if value is not _MISSING:
+                    self.hits += 1
+                    return value
+                self.misses += 1
+                epoch = self.epoch
+                value = await compute()
+                if epoch == self.epoch:
+                    self.data[key] = value
+                    if tags is not None:
+                        self.tag(key, tags)
+                return value
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+    def tag(self, key, tags):
+        if len(self.key_tags) >= 2 * self.data.maxsize:
+            self.key_tags = {
+                k: v for k, v in self.key_tags.items() if k in self.data}
+        self.key_tags[key] = frozenset(tags)
+
+    def invalidate(self, key):
+        self.epoch += 1
+        self.data.pop(key, None)
+
+    def invalidate_tags(self, tags):
+        tags = set(tags)
+        self.epoch += 1
+        for key in [k for k, v in self.key_tags.items() if v & tags]:
+            del self.key_tags[key]
+            self.data.pop(key, None)
+
+    def clear(self):
+        self.epoch += 1
+        self.data.clear()
+        self.key_tags.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": self.data.currsize,
+            "maxsize": self.data.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# Caches the result of an async function for ``ttl`` seconds, keeping at
+# most ``maxsize`` entries (least recently used are evicted first).
+# Concurrent calls with the same key share one computation; exceptions are
+# not cached. ``key`` gets the call arguments and returns a hashable key,
+# pass one when the arguments include a Request, a session, etc.
+# ``tags`` (a list, or a callable getting the call arguments and returning
+# one) names the rows an entry depends on, as "<table>" and "<table>:<id>";
+# model writes invalidate matching entries in every worker.
+# Cached values are shared between callers, do not mutate them.
+#
+#     @cached(ttl=30, key=lambda entity_id, **_: entity_id,
+#             tags=lambda entity_id, **_: ["test:%s" % entity_id])
+#     async def get_entity(entity_id: UUID, user=Depends(...)): ...
+#
+#     get_entity.invalidate(entity_id)
+def cached(ttl=60, maxsize=1024, key=hashkey, name=None, tags=None):
+    def decorator(f):
+        cache = AsyncTTLCache(
+            name or "%s.%s" % (f.__module__, f.__qualname__), ttl, maxsize)
+        caches[cache.name] = cache
+
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            entry_tags = tags(*args, **kwargs) if callable(tags) else tags
+            return await cache.get_or_compute(
+                key(*args, **kwargs), lambda: f(*args, **kwargs), entry_tags)
+
+        def invalidate(*args, **kwargs):
+            cache.invalidate(key(*args, **kwargs))
+
+        wrapper.cache = cache
+        wrapper.invalidate = invalidate
+        return wrapper
+    return decorator
+
+
+def invalidate_all(name=None):
+    for cache in caches.values():
+        if name is None or cache.name == name:
+            cache.clear()
+
+
+def invalidate_tags(tags):
+    for cache in caches.values():
+        cache.invalidate_tags(tags)
+
+
+def cache_stats() -> dict:
+    return {name: cache.stats() for name, cache in caches.items()}
+
+"""
+UTIL_RESPONSES = """
+from datetime import date, datetime, time
+from decimal import Decimal
+from enum import Enum
+from typing import Any
+from uuid import UUID
+import msgpack
+import orjson
+from pydantic import BaseModel
+from starlette.responses import Response
+from app.api.schema.generic_schema import GenericErrorResponseSchema
+from app.core.tracing import span
+from app.utils.negotiation import MSGPACK_MEDIA_TYPE, wants_msgpack
+
+
+def _default(obj):
+    # only called for what orjson does not serialize itself: asyncpg's UUID
+    # subclass, pydantic models (by alias) and gino models
+    if isinstance(obj, UUID):
+        return str(obj)
+    if isinstance(obj, BaseModel):
+        return obj.dict(by_alias=True)
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if hasattr(obj, "to_dict"):
+        return obj.to_dict()
+    raise TypeError
+
+
+def _msgpack_default(obj):
+    # datetimes as in the JSON body; msgpack's timestamp type needs tz-aware
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
+    if isinstance(obj, Enum):
+        return obj.value
+    return _default(obj)
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(
+        content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def packb(content: Any) -> bytes:
+    return msgpack.packb(content, default=_msgpack_default)
+
+
+# JSON, or msgpack when the request's Accept header prefers it; a "+json"
+# vendor content type passed in headers becomes the matching "+msgpack" one
+class FastJSONResponse(Response):
+    media_type = "application/json"
+    msgpack = False
+
+    def render(self, content: Any) -> bytes:
+        with span("render"):
+            if wants_msgpack():
+                self.msgpack = True
+                self.media_type = MSGPACK_MEDIA_TYPE
+                return packb(content)
+            return dumps(content)
+
+    def init_headers(self, headers=None) -> None:
+        super().init_headers(headers)
+        if self.msgpack:
+            self.raw_headers = [
+                (key, value[:-5] + b"+msgpack")
+                if key == b"content-type" and value.endswith(b"+json")
+                else (key, value)
+                for key, value in self.raw_headers]
+        # merged into a Vary the caller passed, e.g. app.utils.conditional's
+        vary = self.headers.get("vary")
+        if vary is None:
+            self.raw_headers.append((b"vary", b"Accept"))
+        elif "accept" not in [value.strip().lower() for value in vary.split(",")]:
+            self.headers["vary"] = vary + ", Accept"
+
+
+def trusted(schema, **values) -> dict:
+    # the envelope as the schema would serialize it, keyed by alias, without
+    # validating values that come from our own code and database
+    return {
+        field.alias: values.get(name, field.default)
+        for name, field in schema.__fields__.items()}
+
+
+# Returning a Response from an endpoint also skips FastAPI's
+# jsonable_encoder / response_model pass.
+def envelope_response(schema, status_code=200, headers=None, **values):
+    return FastJSONResponse(
+        trusted(schema, code=status_code, **values),
+        status_code=status_code,
+        headers=headers)
+
+
+# A CustomHTTPException as the app's handler renders it; middleware, outside
+# the exception handlers, answers with this too
+def error_response(exc) -> FastJSONResponse:
+    return FastJSONResponse(
+        status_code=exc.status_code,
+        headers=exc.headers,
+        content=trusted(
+            GenericErrorResponseSchema,
+            code=exc.status_code,
+            message=exc.message,
+            type=exc.type,
+            details=exc.details))
+
+"""
+UTIL_NEGOTIATION = """
+from contextvars import ContextVar
+import msgpack
+from fastapi.routing import APIRoute
+from starlette.requests import Request
+from app.core.tracing import span
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+
+# set per request by core.middlewares.ContentNegotiation
+_accepts_msgpack = ContextVar("accepts_msgpack", default=False)
+
+
+def is_msgpack(media_type: str) -> bool:
+    media_type = media_type.split(";", 1)[0].strip().lower()
+    return media_type in MSGPACK_MEDIA_TYPES or media_type.endswith("+msgpack")
+
+
+def prefers_msgpack(accept: str) -> bool:
+    # the highest q wins, the first listed on a tie; json stays the default
+    best, best_q = False, 0.0
+    for item in accept.split(","):
+        media_type, _, params = item.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > best_q:
+            best, best_q = is_msgpack(media_type), q
+    return best
+
+
+def negotiate(accept: str):
+    return _accepts_msgpack.set(prefers_msgpack(accept))
+
+
+def reset(token) -> None:
+    _accepts_msgpack.reset(token)
+
+
+def wants_msgpack() -> bool:
+    return _accepts_msgpack.get()
+
+
+class MsgPackRequest(Request):
+    # FastAPI only passes JSON content types to request.json(), so the
+    # msgpack body is presented as one
+    def __init__(self, scope, receive):
+        headers = [
+            (key, value) for key, value in scope["headers"]
+            if key != b"content-type"]
+        headers.append((b"content-type", b"application/json"))
+        super().__init__(dict(scope, headers=headers), receive)
+
+    async def json(self):
+        if not hasattr(self, "_json"):
+            self._json = msgpack.unpackb(await self.body())
+        return self._json
+
+
+# APIRouter(route_class=MsgPackRoute) accepts msgpack request bodies as
+# well as JSON; an undecodable body is a 400
+class MsgPackRoute(APIRoute):
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request):
+            if is_msgpack(request.headers.get("content-type", "")):
+                request = MsgPackRequest(request.scope, request.receive)
+            # body parsing, validation, the endpoint and serialization
+            with span("route", route=self.path):
+                return await handler(request)
+
+        return route_handler
+
+"""
+UTIL_CONDITIONAL = """
+import hashlib
+from typing import Awaitable, Callable, Optional
+from starlette.requests import Request
+from starlette.responses import Response
+from app.core.extensions import db
+from app.core.openapi import etag_matches
+from app.utils.negotiation import wants_msgpack
+
+# clients may keep a copy, but revalidate it on every use
+CONDITIONAL_CACHE_CONTROL = "private, no-cache"
+
+# Conditional GET for read endpoints. Cheapest first:
+#
+#     etag = await collection_etag(Test)      # max(updated) + count
+#     return await conditional(request, etag, lambda: list_tests())
+#
+#     etag = await row_etag(Test, entity_id)  # one indexed lookup
+#
+#     return hashed(request, envelope_response(...))  # full work, no resend
+
+
+def make_etag(*parts) -> str:
+    # JSON and msgpack bodies of the same data are different representations
+    parts += ("msgpack" if wants_msgpack() else "json",)
+    data = "|".join(str(part) for part in parts).encode("utf-8")
+    return '"%s"' % hashlib.sha256(data).hexdigest()[:32]
+
+
+async def collection_etag(model, *clauses, column=None) -> str:
+    # the version column moves on insert and update, the count on delete
+    column = model.updated if column is None else column
+    query = db.select([db.func.max(column), db.func.count()]).select_from(
+        model.__table__)
+    if clauses:
+        query = query.where(db.and_(*clauses))
+    version, count = await query.gino.first()
+    return make_etag(model.__table__.name, version, count)
+
+
+async def row_etag(model, id, column=None) -> Optional[str]:
+    # None when the row does not exist; the full fetch then answers 404
+    column = model.updated if column is None else column
+    version = await db.select([column]).where(model.id == id).gino.scalar()
+    if version is None:
+        return None
+    return make_etag(model.__table__.name, id, version)
+
+
+def not_modified(request: Request, etag: Optional[str],
+                 cache_control: str = CONDITIONAL_CACHE_CONTROL) -> Optional[Response]:
+    if etag and etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers={
+            "ETag": etag, "Cache-Control": cache_control, "Vary": "Accept"})
+    return None
+
+
+async def conditional(request: Request, etag: Optional[str],
+                      build: Callable[[], Awaitable[Response]],
+                      cache_control: str = CONDITIONAL_CACHE_CONTROL) -> Response:
+    # build() only runs when the client's copy is stale
+    response = not_modified(request, etag, cache_control)
+    if response is None:
+        response = await build()
+        if etag and response.status_code == 200:
+            response.headers["ETag"] = etag
+            response.headers["Cache-Control"] = cache_control
+    return response
+
+
+def hashed(request: Request, response: Response,
+           cache_control: str = CONDITIONAL_CACHE_CONTROL) -> Response:
+    body = getattr(response, "body", None)
+    # a StreamingResponse or FileResponse has no body to hash
+    if response.status_code != 200 or body is None:
+        return response
+    etag = '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+    unchanged = not_modified(request, etag, cache_control)
+    if unchanged is not None:
+        return unchanged
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = cache_control
+    return response
+
+"""
+UTIL_SINGLEFLIGHT = """
+import asyncio
+import contextvars
+import copy
+import hashlib
+import inspect
+from functools import wraps
+from starlette.requests import Request
+from app.core.factories import settings
+from app.core.replicas import is_sticky, mark_write
+from app.core.tracing import current_span, set_current
+from app.utils.loader import open_scope
+from app.utils.negotiation import MSGPACK_MEDIA_TYPE, negotiate, wants_msgpack
+
+# every SingleFlight created by @coalesce, by name
+flights = {}
+
+
+class SingleFlight:
+
+    def __init__(self, name):
+        self.name = name
+        self.inflight = {}
+        self.executions = 0
+        self.collapsed = 0
+
+    async def do(self, key, compute):
+        future = self.inflight.get(key)
+        leader = future is None
+        if leader:
+            self.executions += 1
+            # a task of its own, so a leader that disconnects does not
+            # cancel the computation its followers are waiting on; in an
+            # empty context, so it takes a connection of its own rather than
+            # the leader's current one, released when the leader goes away
+            state = (wants_msgpack(), is_sticky(), current_span())
+            future = contextvars.Context().run(
+                asyncio.ensure_future, self._run(compute, state))
+            self.inflight[key] = future
+            future.add_done_callback(lambda done: self._done(key, done))
+        else:
+            self.collapsed += 1
+        result = await asyncio.shield(future)
+        if leader or getattr(result, "background", None) is None:
+            return result
+        # a Response's background tasks run once, after the leader's
+        follower = copy.copy(result)
+        follower.raw_headers = list(result.raw_headers)
+        follower.background = None
+        return follower
+
+    @staticmethod
+    async def _run(compute, state):
+        # the representation and primary stickiness are part of the result,
+        # so they are carried over. The deadline is not: the computation is
+        # shared by requests with different deadlines, and one client's short
+        # X-Request-Timeout must not fail the others; each waiter still stops
+        # waiting at its own deadline. The leader's DataLoaders are not
+        # either; the computation batches its loads in a scope of its own.
+        msgpack, sticky, span = state
+        negotiate(MSGPACK_MEDIA_TYPE if msgpack else "application/json")
+        if sticky:
+            mark_write()
+        set_current(span)
+        open_scope()
+        return await compute()
+
+    def _done(self, key, future):
+        if self.inflight.get(key) is future:
+            del self.inflight[key]
+        if not future.cancelled():
+            # retrieved here in case every waiter went away
+            future.exception()
+
+    def stats(self) -> dict:
+        return {
+            "executions": self.executions,
+            "collapsed": self.collapsed,
+            "inflight": len(self.inflight),
+        }
+
+
+def request_key(request: Request) -> tuple:
+    # route, params and auth scope; the representation too, as a Response
+    # returned by the endpoint is already rendered
+    credentials = "%s|%s" % (
+        request.headers.get("authorization", ""),
+        request.cookies.get(settings.AUTH_COOKIE_NAME, ""))
+    return (
+        request.method,
+        request.url.path,
+        tuple(sorted(request.query_params.multi_items())),
+        hashlib.sha256(credentials.encode("utf-8")).hexdigest(),
+        wants_msgpack(),
+    )
+
+
+# Opt-in for GET endpoints: concurrent identical requests share one call of
+# the endpoint and all get its result. The result object is shared, so do
+# not coalesce endpoints returning a StreamingResponse; the background tasks
+# of a returned Response run for the first caller only. The call runs outside
+# the request: its DataLoaders start empty, in a loader scope of their own.
+#
+#     @router.get("/tests/{entity_id}")
+#     @coalesce()
+#     async def get_test(entity_id: UUID): ...
+def coalesce(name=None, key=request_key):
+    def decorator(f):
+        flight = SingleFlight(name or "%s.%s" % (f.__module__, f.__qualname__))
+        flights[flight.name] = flight
+        signature = inspect.signature(f)
+
+        @wraps(f)
+        async def wrapper(*args, _coalesce_request: Request, **kwargs):
+            if _coalesce_request.method not in ("GET", "HEAD"):
+                return await f(*args, **kwargs)
+            return await flight.do(
+                key(_coalesce_request), lambda: f(*args, **kwargs))
+
+        # FastAPI injects the Request through this extra parameter, which
+        # must come before a **kwargs one
+        parameters = list(signature.parameters.values())
+        position = len(parameters)
+        if parameters and parameters[-1].kind == inspect.Parameter.VAR_KEYWORD:
+            position -= 1
+        parameters.insert(position, inspect.Parameter(
+            "_coalesce_request", inspect.Parameter.KEYWORD_ONLY,
+            annotation=Request))
+        wrapper.__signature__ = signature.replace(parameters=parameters)
+        wrapper.flight = flight
+        return wrapper
+    return decorator
+
+
+def coalesce_stats() -> dict:
+    return {name: flight.stats() for name, flight in flights.items()}
+
+"""
+UTIL_BATCH = """
+import asyncio
+import contextvars
+import logging
+from contextlib import AsyncExitStack
+from http import HTTPStatus
+from typing import List
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from starlette.exceptions import ExceptionMiddleware
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from starlette.requests import Request
+from app.api.exceptions.generic_exception import CustomHTTPException
+from app.api.schema.batch_schema import BatchItemSchema
+from app.api.schema.generic_schema import SuccessResponseSchema
+from app.core.factories import settings
+from app.core.replicas import mark_write
+from app.utils.headers import (
+    BAD_REQUEST_HEADER, INTERNAL_SERVER_ERROR_HEADER, NOT_FOUND_HEADER)
+from app.core.tracing import current_span, set_current
+from app.utils.deadlines import deadline_at, set_deadline_at
+from app.utils.loader import open_scope
+from app.utils.negotiation import negotiate
+from app.utils.responses import dumps, envelope_response, error_response
+from app.utils.types import (
+    BAD_REQUEST_TYPE, BATCH_TYPE, INTERNAL_SERVER_ERROR_TYPE, NOT_FOUND_TYPE)
+
+logger = logging.getLogger(__name__)
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+# set per item; sub-responses are JSON and never compressed
+REPLACED_HEADERS = (
+    b"accept", b"accept-encoding", b"content-encoding", b"content-length",
+    b"content-type", b"expect", b"transfer-encoding")
+
+
+def decode_body(content_type: str, body: bytes):
+    if not body:
+        return None
+    media_type = content_type.split(";", 1)[0].strip()
+    if media_type == "application/json" or media_type.endswith("+json"):
+        return orjson.loads(body)
+    return body.decode("utf-8", "replace")
+
+
+def item_error(status_code: int, details) -> CustomHTTPException:
+    if status_code == 404:
+        headers, type = NOT_FOUND_HEADER, NOT_FOUND_TYPE
+    elif status_code < 500:
+        headers, type = BAD_REQUEST_HEADER, BAD_REQUEST_TYPE
+    else:
+        headers, type = INTERNAL_SERVER_ERROR_HEADER, INTERNAL_SERVER_ERROR_TYPE
+    try:
+        message = HTTPStatus(status_code).phrase
+    except ValueError:
+        message = None
+    return CustomHTTPException(
+        status_code=status_code,
+        message=message,
+        details=details,
+        headers=headers,
+        type=type)
+
+
+# The routes' own 404/405 and FastAPI's 422, in the envelope of the app's
+# errors rather than FastAPI's {"detail": ...}
+async def http_error(request: Request, exc: StarletteHTTPException):
+    return error_response(item_error(exc.status_code, exc.detail))
+
+
+async def validation_error(request: Request, exc: RequestValidationError):
+    return error_response(item_error(422, jsonable_encoder(exc.errors())))
+
+
+# Runs sub-requests against the app's routes in-process: dependencies, auth
+# and the app's exception handlers apply to each item, the middleware stack
+# only once, for the /batch request itself.
+class Batch:
+
+    def __init__(self, request: Request):
+        self.app = request.app
+        self.handler = ExceptionMiddleware(
+            self.app.router,
+            handlers={
+                **self.app.exception_handlers,
+                StarletteHTTPException: http_error,
+                RequestValidationError: validation_error},
+            debug=self.app.debug)
+        # each item gets an exit stack of its own for dependency teardown
+        self.scope = {
+            key: value for key, value in request.scope.items()
+            if key not in (
+                "connection", "endpoint", "fastapi_astack", "path_params",
+                "route")}
+        self.limit = asyncio.Semaphore(settings.BATCH_MAX_CONCURRENCY)
+        self.wrote = False
+        self.deadline = deadline_at()
+        self.span = current_span()
+
+    async def run(self, items: List[BatchItemSchema]) -> list:
+        results = [None] * len(items)
+        pending = []
+
+        async def run_item(index, item):
+            async with self.limit:
+                try:
+                    result = await self.dispatch(item)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.exception(
+                        "Batch item %s %s failed", item.method, item.path)
+                    result = self.failed(e)
+                results[index] = {"id": item.id, **result}
+
+        def start(index, item):
+            # a task in an empty context, so items do not share the batch
+            # request's lazy gino connection, nor their own context variables
+            return contextvars.Context().run(
+                asyncio.ensure_future, run_item(index, item))
+
+        for index, item in enumerate(items):
+            if item.method in SAFE_METHODS:
+                pending.append(start(index, item))
+                continue
+            # writes are barriers: earlier items have finished before they
+            # run, later ones start after them and read from the primary
+            await asyncio.gather(*pending, return_exceptions=True)
+            pending = []
+            await asyncio.gather(start(index, item), return_exceptions=True)
+            self.wrote = True
+        await asyncio.gather(*pending, return_exceptions=True)
+        # whatever went wrong with one item, the others are answered
+        return [
+            result or {
+                "id": item.id, **contextvars.Context().run(self.failed, None)}
+            for item, result in zip(items, results)]
+
+    def sub_scope(self, item: BatchItemSchema, body: bytes) -> dict:
+        path, _, query = item.path.partition("?")
+        item_headers = [
+            (key.lower().encode("latin-1"), value.encode("latin-1"))
+            for key, value in item.headers.items()]
+        replaced = set(REPLACED_HEADERS)
+        replaced.update(key for key, _ in item_headers)
+        headers = [
+            (key, value) for key, value in self.scope["headers"]
+            if key not in replaced]
+        headers.extend(
+            (key, value) for key, value in item_headers
+            if key not in REPLACED_HEADERS)
+        headers.append((b"accept", b"application/json"))
+        if body:
+            headers.append((b"content-type", b"application/json"))
+            headers.append((b"content-length", str(len(body)).encode()))
+        return dict(
+            self.scope,
+            method=item.method,
+            path=path,
+            raw_path=path.encode("utf-8"),
+            query_string=query.encode("latin-1"),
+            headers=headers)
+
+    async def dispatch(self, item: BatchItemSchema) -> dict:
+        negotiate("application/json")
+        open_scope()
+        set_deadline_at(self.deadline)
+        set_current(self.span)
+        if self.wrote:
+            mark_write()
+        body = b"" if item.body is None else dumps(item.body)
+        scope = self.sub_scope(item, body)
+        start = {}
+        chunks = []
+        received = False
+
+        async def receive():
+            nonlocal received
+            if received:
+                # a streaming response listens for a disconnect until it is
+                # done, then cancels this
+                await asyncio.Future()
+            received = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                start.update(message)
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        if scope["path"] == self.scope["path"]:
+            await self.error(scope, receive, send, CustomHTTPException(
+                status_code=400,
+                message="Bad Request",
+                details="Batches cannot be nested",
+                headers=BAD_REQUEST_HEADER,
+                type=BAD_REQUEST_TYPE))
+        else:
+            async with AsyncExitStack() as stack:
+                scope["fastapi_astack"] = stack
+                await self.handler(scope, receive, send)
+        return self.result(
+            start.get("status", 500), start.get("headers", []), b"".join(chunks))
+
+    def failed(self, exc) -> dict:
+        # the item's own context, so the envelope is JSON like the others
+        negotiate("application/json")
+        response = error_response(
+            item_error(500, str(exc or "") or "Internal Server Error"))
+        return self.result(
+            response.status_code, response.raw_headers, response.body)
+
+    @staticmethod
+    def result(status: int, raw_headers, body: bytes) -> dict:
+        headers = {
+            key.decode("latin-1"): value.decode("latin-1")
+            for key, value in raw_headers
+            if key != b"content-length"}
+        return {
+            "status": status,
+            "headers": headers,
+            "body": decode_body(headers.get("content-type", ""), body),
+        }
+
+    async def error(self, scope, receive, send, exc: CustomHTTPException):
+        # the same handler, and so envelope, as errors raised by the routes
+        handler = self.app.exception_handlers[CustomHTTPException]
+        response = await handler(Request(scope, receive), exc)
+        await response(scope, receive, send)
+
+
+async def batch_response(request: Request, items: List[BatchItemSchema]):
+    if len(items) > settings.BATCH_MAX_REQUESTS:
+        raise CustomHTTPException(
+            status_code=400,
+            message="Bad Request",
+            details="A batch takes at most %d requests" % settings.BATCH_MAX_REQUESTS,
+            headers=BAD_REQUEST_HEADER,
+            type=BAD_REQUEST_TYPE)
+    return envelope_response(
+        SuccessResponseSchema,
+        type=BATCH_TYPE,
+        message="OK",
+        details=await Batch(request).run(items))
+
+"""
+UTIL_LOADER = """
+import asyncio
+import contextvars
+import weakref
+from contextvars import ContextVar
+from sqlalchemy import any_, bindparam
+from sqlalchemy.dialects.postgresql import ARRAY
+from app.core.extensions import db
+from app.core.replicas import is_sticky, mark_write
+from app.core.tracing import current_span, set_current
+from app.utils.deadlines import deadline_at, set_deadline_at
+
+# (model, column, many) -> DataLoader for the current request; a fresh dict
+# per request from core.middlewares.LoaderScope
+_loaders = ContextVar("loaders", default=None)
+
+# GinoConnection -> lock, so loaders sharing a transaction's connection
+# query it one at a time
+_connection_locks = weakref.WeakKeyDictionary()
+
+
+def connection_lock(conn) -> asyncio.Lock:
+    lock = _connection_locks.get(conn)
+    if lock is None:
+        lock = _connection_locks[conn] = asyncio.Lock()
+    return lock
+
+
+# Batches lookups of one model by one column: every load() made before the
+# event loop comes back round becomes a single WHERE column = ANY($1) query.
+# Results, misses included, are kept for the rest of the request.
+#
+#     authors = await loader(Author).load_many(post.author_id for post in posts)
+#     comments = await loader(Comment, "post_id", many=True).load(post.id)
+#
+# Keys must be of the column's python type (UUID, not str) to match rows.
+# Outside a request scope, e.g. in a script, every loader() call gives a new
+# DataLoader, so only loads made through the same instance are batched.
+class DataLoader:
+
+    def __init__(self, model, column="id", many=False):
+        self.model = model
+        self.column = getattr(model, column)
+        self.attribute = column
+        self.many = many
+        self.cache = {}
+        self.queue = []
+        self.batches = 0
+
+    async def load(self, key):
+        future = self.cache.get(key)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = self.cache[key] = loop.create_future()
+            self.queue.append(key)
+            if len(self.queue) == 1:
+                loop.call_soon(self.dispatch)
+        # shared by every caller of the key: one of them being cancelled
+        # must not cancel it for the others
+        return await asyncio.shield(future)
+
+    async def load_many(self, keys) -> list:
+        return await asyncio.gather(*[self.load(key) for key in keys])
+
+    def clear(self, key=None) -> None:
+        # after writing rows this request has loaded
+        if key is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(key, None)
+
+    def dispatch(self) -> None:
+        keys, self.queue = self.queue, []
+        futures = [self.cache[key] for key in keys]
+        conn = getattr(db.bind, "current_connection", None)
+        if conn is not None:
+            # inside db.transaction() or db.acquire(): the query must see the
+            # rows written on that connection, so it runs there too, after
+            # other loaders' queries; do not gather loads with the endpoint's
+            # own queries there, a connection runs one statement at a time
+            asyncio.ensure_future(self.fetch(keys, futures, conn=conn))
+            return
+        # Otherwise in an empty context, so the query takes a connection of
+        # its own rather than one the endpoint's next query may be waiting
+        # on. The deadline, trace and primary stickiness are carried over.
+        state = (deadline_at(), current_span(), is_sticky())
+        contextvars.Context().run(
+            asyncio.ensure_future, self.fetch(keys, futures, state))
+
+    async def fetch(self, keys, futures, state=None, conn=None) -> None:
+        if state is not None:
+            deadline, span, sticky = state
+            set_deadline_at(deadline)
+            set_current(span)
+            if sticky:
+                mark_write()
+        self.batches += 1
+        values = bindparam(
+            "keys", list(keys), type_=ARRAY(self.column.type))
+        query = self.model.query.where(self.column == any_(values))
+        try:
+            if conn is None:
+                rows = await query.gino.all()
+            else:
+                async with connection_lock(conn):
+                    rows = await conn.all(query)
+        except Exception as e:
+            for key, future in zip(keys, futures):
+                # not cached, a later load of the key tries again
+                if self.cache.get(key) is future:
+                    del self.cache[key]
+                if not future.done():
+                    future.set_exception(e)
+            return
+        found = {}
+        for row in rows:
+            value = getattr(row, self.attribute)
+            if self.many:
+                found.setdefault(value, []).append(row)
+            else:
+                found[value] = row
+        for key, future in zip(keys, futures):
+            if not future.done():
+                future.set_result(found.get(key, [] if self.many else None))
+
+
+def loader(model, column="id", many=False) -> DataLoader:
+    loaders = _loaders.get()
+    if loaders is None:
+        # outside a request scope nothing is cached between calls
+        return DataLoader(model, column, many)
+    key = (model, column, many)
+    instance = loaders.get(key)
+    if instance is None:
+        instance = loaders[key] = DataLoader(model, column, many)
+    return instance
+
+
+def open_scope():
+    return _loaders.set({})
+
+
+def close_scope(token) -> None:
+    _loaders.reset(token)
+
+"""
+UTIL_IDS = """
+import os
+import time
+from uuid import UUID, uuid4
+from app.core.factories import settings
+
+# version 7 layout: 48 bit unix time in ms, version, a 12 bit sequence that
+# orders ids made in the same ms, variant, 62 random bits
+UUID7_VERSION = 0x7000 << 64
+UUID7_VARIANT = 0x8000000000000000
+UUID7_RANDOM = 0x3FFFFFFFFFFFFFFF
+UUID7_MAX_SEQUENCE = 0xFFF
+
+# last ms and sequence handed out: ids from this process sort in the order
+# they were made, even if the clock steps back
+_uuid7_state = [0, -1]
+
+
+def uuid4_batch(count):
+    # one urandom call for the whole batch instead of one per id
+    data = os.urandom(16 * count)
+    return [UUID(bytes=data[i:i + 16], version=4)
+            for i in range(0, 16 * count, 16)]
+
+
+def uuid7_batch(count):
+    last_ms, sequence = _uuid7_state
+    ms = time.time_ns() // 1000000
+    if ms > last_ms:
+        sequence = -1
+    else:
+        ms = last_ms
+    data = os.urandom(8 * count)
+    ids = []
+    for i in range(0, 8 * count, 8):
+        sequence += 1
+        if sequence > UUID7_MAX_SEQUENCE:
+            # borrow the next ms rather than reuse a sequence number
+            ms += 1
+            sequence = 0
+        ids.append(UUID(int=(
+            ms << 80 | UUID7_VERSION | sequence << 64 | UUID7_VARIANT
+            | int.from_bytes(data[i:i + 8], "big") & UUID7_RANDOM)))
+    _uuid7_state[:] = ms, sequence
+    return ids
+
+
+def uuid7():
+    return uuid7_batch(1)[0]
+
+
+# version -> (one id, a list of count ids)
+GENERATORS = {
+    4: (uuid4, uuid4_batch),
+    7: (uuid7, uuid7_batch),
+}
+
+
+def uuid_generators(version=None):
+    # time ordered ids (7) keep primary key inserts at the right edge of the
+    # btree; random ones (4) spread them over every leaf page
+    return GENERATORS[version or settings.DB_UUID_VERSION]
+
+"""
+UTIL_DEADLINES = """
+import time
+from contextvars import ContextVar
+from typing import Optional
+from app.api.exceptions.generic_exception import CustomHTTPException
+from app.utils.headers import GATEWAY_TIMEOUT_HEADER
+from app.utils.types import GATEWAY_TIMEOUT_TYPE
+
+# a client may shorten, never extend, its request's deadline with this
+TIMEOUT_HEADER = "X-Request-Timeout"
+
+# time.monotonic() by which the current request must be answered, and the
+# timer that cancels it then; set by core.middlewares.Deadline
+_deadline = ContextVar("deadline", default=None)
+_timer = ContextVar("deadline_timer", default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def parse_route_timeouts(items) -> list:
+    # "path-prefix=seconds" items, longest prefix first; 0 is no deadline
+    timeouts = []
+    for item in items:
+        if not item.strip():
+            continue
+        prefix, _, seconds = item.partition("=")
+        timeouts.append((prefix.strip(), float(seconds)))
+    return sorted(timeouts, key=lambda item: -len(item[0]))
+
+
+def set_deadline(seconds: float):
+    return _deadline.set(time.monotonic() + seconds)
+
+
+def set_deadline_at(deadline: Optional[float]):
+    return _deadline.set(deadline)
+
+
+def reset(token) -> None:
+    _deadline.reset(token)
+
+
+def set_timer(timer):
+    return _timer.set(timer)
 
 
-DB_SETUP = """
-from uuid import uuid4
-# add created,updated columns to model
-from sqlalchemy_utils import UUIDType, Timestamp
-from app.core.extensions import db
+def reset_timer(token) -> None:
+    _timer.reset(token)
 
 
-class SurrogatePK(object):
-    __table_args__ = {"extend_existing": True}
+def clear_deadline() -> None:
+    # for a response that may rightly outlive the deadline, e.g. a streamed
+    # export: its statements are no longer capped, nor is it cancelled
+    _deadline.set(None)
+    timer = _timer.get()
+    if timer is not None:
+        timer.cancel()
 
-    id = db.Column(UUIDType(binary=False), primary_key=True)
 
+def deadline_at() -> Optional[float]:
+    return _deadline.get()
 
-class SurrogateAudit(object):
 
-    __table_args__ = {"extend_existing": True}
+def remaining() -> Optional[float]:
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
 
-    _created = db.Column(db.Time(), nullable=True)
-    _modified = db.Column(db.Time(), nullable=True)
-    _created_by = db.Column(db.String(), nullable=True)
-    _modified_by = db.Column(db.String(), nullable=True)
 
+# The timeout for a blocking call, `timeout` capped to what is left of the
+# request's deadline; pass it on to outbound calls as well:
+#
+#     requests.get(url, timeout=budget(5.0), headers=outbound_headers())
+def budget(timeout: Optional[float] = None) -> Optional[float]:
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded()
+    return left if timeout is None else min(timeout, left)
 
-class Model(Timestamp, SurrogatePK, SurrogateAudit, db.Model):
-    __abstract__ = True
 
-    @classmethod
-    async def create(cls, **kwargs):
-        if issubclass(cls, SurrogatePK):
-            unique_id = uuid4()
-            if not kwargs.get("id"):
-                kwargs["id"] = unique_id
-        return await cls(**kwargs)._create()
+def outbound_headers() -> dict:
+    # downstream services of ours then stop when we would
+    left = remaining()
+    if left is None:
+        return {}
+    return {TIMEOUT_HEADER: "%.3f" % max(left, 0.0)}
+
+
+def gateway_timeout() -> CustomHTTPException:
+    return CustomHTTPException(
+        status_code=504,
+        message="Gateway Timeout",
+        details="The request deadline passed",
+        headers=GATEWAY_TIMEOUT_HEADER,
+        type=GATEWAY_TIMEOUT_TYPE)
 
 """
 UTIL_HEADERS = """
@@ -476,6 +2864,8 @@ NOT_FOUND_HEADER: Final = {"Content-Type": "application/vnd+test.service.entity.
 NOT_ACCEPTABLE_HEADER: Final = {"Content-Type": "application/vnd+test.service.entity.not-acceptable+json"}  # noqa
 INTERNAL_SERVER_ERROR_HEADER: Final = {"Content-Type": "application/vnd+test.service.internal-server-error+json"}  # noqa
 BAD_REQUEST_HEADER: Final = {"Content-Type": "application/vnd+test.service.bad-request+json"}  # noqa
+SERVICE_UNAVAILABLE_HEADER: Final = {"Content-Type": "application/vnd+test.service.unavailable+json"}  # noqa
+GATEWAY_TIMEOUT_HEADER: Final = {"Content-Type": "application/vnd+test.service.gateway-timeout+json"}  # noqa
 """
 UTIL_TYPES = """
 from typing_extensions import Final
@@ -488,13 +2878,52 @@ NOT_ACCEPTABLE_TYPE: Final = "vnd.test.service.entity.not-acceptable"
 INTERNAL_SERVER_ERROR_TYPE: Final = "vnd.test.service.internal-server-error"
 BAD_REQUEST_TYPE: Final = "vnd.test.service.bad_request"
 PARTIAL_CONTENT_TYPE: Final = "vnd.test.service.partial-content"
+BATCH_TYPE: Final = "vnd.test.service.batch"
+SERVICE_UNAVAILABLE_TYPE: Final = "vnd.test.service.unavailable"
+GATEWAY_TIMEOUT_TYPE: Final = "vnd.test.service.gateway-timeout"
 """
 
 EXTENTIONS = """
 from app.core.factories import settings
+from app.core.invalidation import CacheInvalidator
+from app.core.limiter import AdaptiveLimiter
+from app.core.metrics import InstrumentedConnection, PoolMetrics
+from app.core.pool import DeadlineConnection, PoolMonitor
+from app.core.replicas import ReplicaSet
+from app.core.tracing import JsonLinesExporter, Tracer
+from app.core.writebehind import WriteBehind
 from ssl import create_default_context
 from gino_starlette import Gino
 
+pool_monitor = PoolMonitor()
+
+# passed through gino to asyncpg.create_pool; pgbouncer in transaction mode
+# cannot keep named prepared statements, so the statement cache is disabled
+pool_options = dict(
+    pool_class=pool_monitor.pool_class(),
+    connection_class=(
+        InstrumentedConnection
+        if settings.METRICS_ENABLED or settings.TRACING_ENABLED
+        else DeadlineConnection),
+    max_inactive_connection_lifetime=settings.DB_POOL_MAX_INACTIVE_LIFETIME,
+    statement_cache_size=(
+        0 if settings.DB_PGBOUNCER else settings.DB_STATEMENT_CACHE_SIZE),
+    command_timeout=settings.DB_COMMAND_TIMEOUT,
+)
+# replicas get their own pools (and monitors) with the same options
+replica_options = dict(
+    pool_options,
+    min_size=settings.DB_POOL_MIN_SIZE,
+    max_size=settings.DB_POOL_MAX_SIZE,
+)
+del replica_options["pool_class"]
+listen_options = {}
+
+# With replicas, no lazy connection per request: a request's reads are
+# routed one by one (app.core.replicas) and take a pooled connection only for
+# the statement; db.transaction() / db.acquire() still pin their block to one
+# connection.
+use_connection_for_request = not settings.DATABASE_REPLICA_URLS
 
 if not settings.DEBUG:
     ssl_object = create_default_context(cafile=settings.SSL_CERT_FILE)
@@ -502,18 +2931,1264 @@ if not settings.DEBUG:
         dsn=settings.DATABASE_URL,
         echo=False,
         ssl=ssl_object,
-        pool_min_size=3,
-        pool_max_size=20,
+        pool_min_size=settings.DB_POOL_MIN_SIZE,
+        pool_max_size=settings.DB_POOL_MAX_SIZE,
         retry_limit=1,
         retry_interval=1,
+        use_connection_for_request=use_connection_for_request,
+        kwargs=pool_options,
     )
+    replica_options["ssl"] = ssl_object
+    listen_options["ssl"] = ssl_object
 else:
     db: Gino = Gino(
         dsn=settings.DATABASE_URL,
-        echo=False)
+        echo=False,
+        pool_min_size=settings.DB_POOL_MIN_SIZE,
+        pool_max_size=settings.DB_POOL_MAX_SIZE,
+        use_connection_for_request=use_connection_for_request,
+        kwargs=pool_options)
+
+replicas = ReplicaSet(
+    db,
+    settings.DATABASE_REPLICA_URLS,
+    health_interval=settings.DB_REPLICA_HEALTH_INTERVAL,
+    max_lag=settings.DB_REPLICA_MAX_LAG,
+    **replica_options)
+
+invalidator = CacheInvalidator(
+    db,
+    settings.DATABASE_LISTEN_URL or settings.DATABASE_URL,
+    settings.CACHE_INVALIDATION_CHANNEL,
+    keepalive=settings.CACHE_INVALIDATION_KEEPALIVE,
+    enabled=settings.CACHE_INVALIDATION,
+    **listen_options)
+
+write_behind = WriteBehind(
+    max_batch=settings.WRITE_BEHIND_MAX_BATCH,
+    flush_interval=settings.WRITE_BEHIND_FLUSH_INTERVAL,
+    max_queue=settings.WRITE_BEHIND_MAX_QUEUE,
+    shutdown_timeout=settings.WRITE_BEHIND_SHUTDOWN_TIMEOUT)
+
+limiter = AdaptiveLimiter(
+    pool_monitor,
+    initial=settings.LIMITER_INITIAL,
+    min_limit=settings.LIMITER_MIN,
+    max_limit=settings.LIMITER_MAX,
+    backoff=settings.LIMITER_BACKOFF,
+    tolerance=settings.LIMITER_TOLERANCE,
+    priorities=settings.LIMITER_ROUTE_PRIORITIES)
+
+pool_metrics = PoolMetrics(
+    pool_monitor, replicas, interval=settings.METRICS_POOL_INTERVAL)
+
+tracer = Tracer(
+    JsonLinesExporter(settings.TRACING_FILE),
+    ratio=settings.TRACING_SAMPLE_RATIO,
+    trust_parent=settings.TRACING_TRUST_PARENT)
+
+"""
+
+POOL = """
+import asyncio
+import time
+from asyncpg import Connection
+from gino.dialects.asyncpg import Pool
+from app.utils.deadlines import DeadlineExceeded, budget
+
+
+class MonitoredPool(Pool):
+    # gino creates the pool from the class it is given, so the monitor is
+    # bound through PoolMonitor.pool_class()
+    monitor = None
+
+    async def _init(self):
+        await super()._init()
+        self.monitor.pool = self._pool
+        return self
+
+    async def acquire(self, *, timeout=None):
+        capped = budget(timeout)
+        try:
+            return await self.monitor.timed(self._pool.acquire(timeout=capped))
+        except asyncio.TimeoutError:
+            if capped != timeout:
+                raise DeadlineExceeded()
+            raise
+
+
+# connection_class for the pools: statement timeouts are capped to what is
+# left of the request deadline. asyncpg cancels a timed out statement on the
+# server, so the connection goes back to the pool right away.
+class DeadlineConnection(Connection):
+
+    async def _do_execute(self, query, executor, timeout, *args, **kwargs):
+        if timeout is None:
+            timeout = self._config.command_timeout
+        capped = budget(timeout)
+        try:
+            return await super()._do_execute(
+                query, executor, capped, *args, **kwargs)
+        except asyncio.TimeoutError:
+            if capped != timeout:
+                raise DeadlineExceeded()
+            raise
+
+
+class PoolMonitor:
+
+    def __init__(self) -> None:
+        self.pool = None
+        self.waiting = 0
+        self.acquired = 0
+        self.acquire_wait_total = 0.0
+        self.acquire_wait_max = 0.0
+
+    def pool_class(self):
+        return type("MonitoredPool", (MonitoredPool,), {"monitor": self})
+
+    async def timed(self, acquire):
+        # only a caller that finds no idle connection is queued; the limiter
+        # reads any waiter as saturation
+        queued = self.pool is not None and self.pool.get_idle_size() == 0
+        self.waiting += queued
+        start = time.perf_counter()
+        try:
+            return await acquire
+        finally:
+            elapsed = time.perf_counter() - start
+            self.waiting -= queued
+            self.acquired += 1
+            self.acquire_wait_total += elapsed
+            self.acquire_wait_max = max(self.acquire_wait_max, elapsed)
+
+    def stats(self) -> dict:
+        if self.pool is None:
+            return {}
+        size = self.pool.get_size()
+        idle = self.pool.get_idle_size()
+        return {
+            "min_size": self.pool.get_min_size(),
+            "max_size": self.pool.get_max_size(),
+            "size": size,
+            "in_use": size - idle,
+            "idle": idle,
+            "waiting": self.waiting,
+            "acquired": self.acquired,
+            "acquire_wait_avg": (
+                self.acquire_wait_total / self.acquired if self.acquired else 0.0),
+            "acquire_wait_max": self.acquire_wait_max,
+        }
+
+"""
+
+REPLICAS = """
+import asyncio
+import itertools
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from asyncpg.exceptions import (
+    AdminShutdownError, CannotConnectNowError, ConnectionDoesNotExistError,
+    PostgresConnectionError)
+from gino import create_engine
+from sqlalchemy import text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.expression import Select
+from app.core.pool import PoolMonitor
+
+logger = logging.getLogger(__name__)
+
+# errors after which a read is retried on the primary
+FAILOVER_ERRORS = (
+    OSError, ConnectionDoesNotExistError, PostgresConnectionError,
+    CannotConnectNowError, AdminShutdownError)
+
+# replay lag in seconds; 0 when everything received has been replayed
+# (and on a server that is not in recovery)
+LAG_QUERY = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+    "THEN 0 ELSE COALESCE(EXTRACT(EPOCH FROM "
+    "now() - pg_last_xact_replay_timestamp()), 0) END")
+
+# set once the current request has written, so its later reads see the write
+_sticky = ContextVar("replicas_sticky", default=False)
+_forced = ContextVar("replicas_forced", default=False)
+
+
+def mark_write():
+    _sticky.set(True)
+
+
+def is_sticky() -> bool:
+    return _sticky.get() or _forced.get()
+
+
+async def use_primary():
+    # Depends(use_primary): every read of the request goes to the primary
+    mark_write()
+
+
+@contextmanager
+def primary():
+    token = _forced.set(True)
+    try:
+        yield
+    finally:
+        _forced.reset(token)
+
+
+class Replica:
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.name = repr(make_url(dsn))
+        self.monitor = PoolMonitor()
+        self.engine = None
+        self.healthy = False
+        self.lag = None
+        self.error = None
+
+    def stats(self) -> dict:
+        return {
+            "url": self.name,
+            "healthy": self.healthy,
+            "lag": self.lag,
+            "error": self.error,
+            "pool": self.monitor.stats(),
+        }
+
+
+class RoutingEngine:
+    # stands in for the primary engine as db.bind: SELECTs go to a healthy
+    # replica, everything else (and the rest of the engine API) to the primary
+
+    def __init__(self, primary, replicas):
+        self.primary = primary
+        self.replicas = replicas
+
+    def __getattr__(self, name):
+        return getattr(self.primary, name)
+
+    def route(self, clause):
+        if not isinstance(clause, Select):
+            mark_write()
+            return None
+        # a current connection means an explicit transaction or acquire,
+        # whose reads must see its own writes
+        if (clause._for_update_arg is not None or _sticky.get()
+                or _forced.get() or self.primary.current_connection is not None):
+            return None
+        return self.replicas.choose()
+
+    async def _execute(self, method, clause, *multiparams, **params):
+        replica = self.route(clause)
+        if replica is not None:
+            try:
+                return await getattr(replica.engine, method)(
+                    clause, *multiparams, **params)
+            except FAILOVER_ERRORS as e:
+                self.replicas.mark_down(replica, e)
+        return await getattr(self.primary, method)(
+            clause, *multiparams, **params)
+
+    async def all(self, clause, *multiparams, **params):
+        return await self._execute("all", clause, *multiparams, **params)
+
+    async def first(self, clause, *multiparams, **params):
+        return await self._execute("first", clause, *multiparams, **params)
+
+    async def one(self, clause, *multiparams, **params):
+        return await self._execute("one", clause, *multiparams, **params)
+
+    async def one_or_none(self, clause, *multiparams, **params):
+        return await self._execute(
+            "one_or_none", clause, *multiparams, **params)
+
+    async def scalar(self, clause, *multiparams, **params):
+        return await self._execute("scalar", clause, *multiparams, **params)
+
+    async def status(self, clause, *multiparams, **params):
+        mark_write()
+        return await self.primary.status(clause, *multiparams, **params)
+
+
+class ReplicaSet:
+
+    def __init__(self, db, dsns, health_interval=5.0, max_lag=10.0,
+                 **engine_options):
+        self.db = db
+        self.replicas = [Replica(dsn) for dsn in dsns]
+        self.health_interval = health_interval
+        self.max_lag = max_lag
+        self.engine_options = engine_options
+        self._next = itertools.count()
+        self._health_task = None
+
+    def choose(self):
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self._next) % len(healthy)]
+
+    def mark_down(self, replica, error):
+        logger.warning("replica %s failed, using primary: %r",
+                       replica.name, error)
+        replica.healthy = False
+        replica.error = repr(error)
+
+    async def connect(self):
+        # after gino's startup handler has bound the primary
+        if not self.replicas:
+            return
+        await self.check()
+        self.db.bind = RoutingEngine(self.db.bind, self)
+        self._health_task = asyncio.ensure_future(self._health_loop())
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+            self._health_task = None
+        for replica in self.replicas:
+            if replica.engine is not None:
+                await replica.engine.close()
+                replica.engine = None
+            replica.healthy = False
+
+    async def check(self):
+        await asyncio.gather(*(self._check(replica) for replica in self.replicas))
+
+    async def _check(self, replica):
+        try:
+            if replica.engine is None:
+                replica.engine = await asyncio.wait_for(create_engine(
+                    replica.dsn, pool_class=replica.monitor.pool_class(),
+                    **self.engine_options), self.health_interval)
+            lag = await asyncio.wait_for(
+                replica.engine.scalar(LAG_QUERY), self.health_interval)
+        except Exception as e:  # noqa
+            if replica.healthy or replica.error is None:
+                logger.warning("replica %s is down: %r", replica.name, e)
+            replica.healthy = False
+            replica.error = repr(e)
+            return
+        replica.lag = float(lag)
+        replica.healthy = replica.lag <= self.max_lag
+        replica.error = None if replica.healthy else "lagging"
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.check()
+
+    def stats(self) -> list:
+        return [replica.stats() for replica in self.replicas]
+
+"""
+
+INVALIDATION = """
+import asyncio
+import json
+import logging
+import asyncpg
+from sqlalchemy.engine.url import make_url
+from app.utils.cache import invalidate_all, invalidate_tags
+
+logger = logging.getLogger(__name__)
+
+# NOTIFY payloads are capped at 8000 bytes
+MAX_PAYLOAD = 7999
+
+
+class CacheInvalidator:
+    # one LISTEN connection per worker, outside the gino pool; writes are
+    # published with pg_notify on the writing connection, so they reach the
+    # other workers when (and only if) the transaction commits
+
+    def __init__(self, db, dsn, channel, keepalive=10.0, retry_interval=1.0,
+                 enabled=True, **connect_options):
+        url = make_url(dsn)
+        self.db = db
+        self.channel = channel
+        self.enabled = enabled
+        self.keepalive = keepalive
+        self.retry_interval = retry_interval
+        self.connect_options = dict(
+            host=url.host, port=url.port, user=url.username,
+            password=url.password, database=url.database, **connect_options)
+        self.connected = False
+        self.received = 0
+        self._task = None
+
+    async def publish(self, tags):
+        tags = list(tags)
+        # this worker does not wait for its own notification
+        invalidate_tags(tags)
+        if not self.enabled:
+            return
+        payload = json.dumps(tags)
+        if len(payload.encode()) > MAX_PAYLOAD:
+            # keep the table tags, which cover every row
+            payload = json.dumps([tag for tag in tags if ":" not in tag])
+        async with self.db.acquire(reuse=True) as conn:
+            await conn.scalar(
+                self.db.select([self.db.func.pg_notify(self.channel, payload)]))
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self.received += 1
+        try:
+            invalidate_tags(json.loads(payload))
+        except ValueError:
+            logger.warning("ignoring cache invalidation %r", payload)
+
+    async def start(self):
+        self._task = asyncio.ensure_future(self._listen())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _listen(self):
+        while True:
+            conn = None
+            lost = asyncio.Event()
+            try:
+                conn = await asyncpg.connect(
+                    timeout=self.keepalive, **self.connect_options)
+                conn.add_termination_listener(lambda _: lost.set())
+                await conn.add_listener(self.channel, self._on_notify)
+                # notifications sent while nobody listened are lost
+                invalidate_all()
+                self.connected = True
+                while not lost.is_set():
+                    try:
+                        await asyncio.wait_for(lost.wait(), self.keepalive)
+                    except asyncio.TimeoutError:
+                        await conn.fetchval("SELECT 1", timeout=self.keepalive)
+                logger.warning("cache invalidation connection closed")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # noqa
+                logger.warning("cache invalidation connection failed: %r", e)
+            finally:
+                self.connected = False
+                if conn is not None:
+                    conn.terminate()
+            await asyncio.sleep(self.retry_interval)
+
+    def stats(self) -> dict:
+        return {"connected": self.connected, "received": self.received}
+
+"""
+
+STATIC_FILES = """
+import stat
+from mimetypes import guess_type
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Scope
+from app.core.middlewares import accepted_encodings
+
+PRECOMPRESSED_SUFFIXES = (("br", ".br"), ("gzip", ".gz"))
+# only safe for fingerprinted file names (styles.3f9a1c.css)
+STATIC_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+# Serves "<file>.br" / "<file>.gz", written by `doit precompress_static`,
+# to clients that accept them. FileResponse adds ETag and Last-Modified and
+# answers If-None-Match with 304. Starlette 0.16 streams the file from a
+# thread; it has no sendfile path.
+class PrecompressedStaticFiles(StaticFiles):
+
+    def __init__(self, *args, cache_control: str = STATIC_CACHE_CONTROL, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_control = cache_control
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        response = None
+        if scope["method"] in ("GET", "HEAD"):
+            response = await self.precompressed_response(path, scope)
+        if response is None:
+            response = await super().get_response(path, scope)
+        if response.status_code in (200, 304):
+            response.headers["cache-control"] = self.cache_control
+            response.headers.add_vary_header("Accept-Encoding")
+        return response
+
+    async def precompressed_response(self, path: str, scope: Scope):
+        accepted = accepted_encodings(Headers(scope=scope).get("accept-encoding", ""))
+        for encoding, suffix in PRECOMPRESSED_SUFFIXES:
+            if encoding not in accepted:
+                continue
+            full_path, stat_result = await self.lookup_path(path + suffix)
+            if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
+                continue
+            response = self.file_response(full_path, stat_result, scope)
+            if response.status_code == 200:
+                content_type = guess_type(path)[0] or "text/plain"
+                if content_type.startswith("text/"):
+                    content_type += "; charset=utf-8"
+                response.headers["content-type"] = content_type
+                response.headers["content-encoding"] = encoding
+            return response
+        return None
+
+"""
+
+PARTITIONS = """
+import asyncio
+from datetime import datetime, timedelta
+from app.core.dbsetup import db, partitioned_models
+from app.core.factories import settings
+
+# Partition upkeep for TimePartitioned models: `doit partitions`, run daily.
+# Partitions are named <table>_p<YYYYMMDD> after their first day.
+
+
+def interval_start(moment: datetime, interval: str) -> datetime:
+    day = datetime(moment.year, moment.month, moment.day)
+    if interval == "day":
+        return day
+    if interval == "week":
+        return day - timedelta(days=day.weekday())
+    if interval == "month":
+        return day.replace(day=1)
+    raise ValueError("Unknown partition interval %r" % interval)
+
+
+def shift(start: datetime, interval: str, steps: int) -> datetime:
+    if interval == "day":
+        return start + timedelta(days=steps)
+    if interval == "week":
+        return start + timedelta(weeks=steps)
+    months = start.year * 12 + start.month - 1 + steps
+    return start.replace(year=months // 12, month=months % 12 + 1)
+
+
+def partition_name(table: str, start: datetime) -> str:
+    return "%s_p%s" % (table, start.strftime("%Y%m%d"))
+
+
+def is_partition(name: str, table: str = None) -> bool:
+    tables = [table] if table else partitioned_models
+    for table in tables:
+        suffix = name[len(table) + 2:]
+        if name.startswith(table + "_p") and len(suffix) == 8 and suffix.isdigit():
+            return True
+    return False
+
+
+async def attached_partitions(table: str) -> list:
+    rows = await db.all(db.text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(:table)"), table=table)
+    return [row[0] for row in rows]
+
+
+async def maintain(model, now: datetime = None):
+    # the current partition and __partition_premake__ after it exist;
+    # partitions older than __partition_retention__ intervals are detached,
+    # left as plain tables to archive or drop
+    table = model.__tablename__
+    interval = model.__partition_interval__
+    current = interval_start(now or datetime.utcnow(), interval)
+    attached = set(await attached_partitions(table))
+    created = []
+    for step in range(model.__partition_premake__ + 1):
+        start = shift(current, interval, step)
+        name = partition_name(table, start)
+        if name in attached:
+            continue
+        await db.status(db.text(
+            'CREATE TABLE "%s" PARTITION OF "%s" '
+            "FOR VALUES FROM ('%s') TO ('%s')" % (
+                name, table, start.isoformat(" "),
+                shift(start, interval, 1).isoformat(" "))))
+        created.append(name)
+    detached = []
+    if model.__partition_retention__:
+        oldest = partition_name(
+            table, shift(current, interval, -model.__partition_retention__))
+        for name in sorted(attached):
+            if is_partition(name, table) and name < oldest:
+                await db.status(db.text(
+                    'ALTER TABLE "%s" DETACH PARTITION "%s"' % (
+                        table, name)))
+                detached.append(name)
+    return created, detached
+
+
+async def main():
+    # the models register themselves on import
+    import app.db.models  # noqa
+
+    await db.set_bind(settings.DATABASE_URL)
+    try:
+        for table, model in sorted(partitioned_models.items()):
+            created, detached = await maintain(model)
+            print("%s: created %s, detached %s" % (
+                table, created or "none", detached or "none"))
+    finally:
+        await db.pop_bind().close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
+
+"""
+WRITE_BEHIND = """
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+# Write-behind for high rate, fire-and-forget inserts (audit, events):
+# rows are queued and written by one task with bulk_create, a batch at a
+# time, once max_batch rows are waiting or flush_interval after the first.
+# A full queue makes add() wait, so producers slow down to what the database
+# takes. Rows still queued are written on shutdown, for up to
+# shutdown_timeout seconds. A failed batch is rolled back and retried row by
+# row; rows that fail again are logged and dropped.
+#
+#     await Audit.create_buffered(action="login", user_id=user.id)
+class WriteBehind:
+
+    def __init__(self, max_batch=1000, flush_interval=0.5, max_queue=10000,
+                 shutdown_timeout=10.0):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.shutdown_timeout = shutdown_timeout
+        self.queue = None
+        self.task = None
+        self.filled = None
+        self.stopping = False
+        self.blocked = 0
+        self.flushes = 0
+        self.rows = 0
+        self.failed_rows = 0
+        self.batch_size_max = 0
+        self.flush_seconds_total = 0.0
+        self.flush_seconds_max = 0.0
+
+    async def add(self, model, row: dict) -> None:
+        if self.task is None:
+            # not started (scripts, tests): written now
+            await model.bulk_create([row])
+            return
+        if self.queue.full():
+            self.blocked += 1
+        await self.queue.put((model, row))
+        if self.queue.qsize() >= self.max_batch:
+            self.filled.set()
+
+    async def start(self) -> None:
+        # created here, on the running loop
+        self.queue = asyncio.Queue(self.max_queue)
+        self.filled = asyncio.Event()
+        self.task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self.task is None:
+            return
+        # no more waiting for a batch to fill
+        self.stopping = True
+        self.filled.set()
+        try:
+            # the writer may have died, or the database be gone
+            await asyncio.wait_for(self.queue.join(), self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            left = self.queue.qsize()
+            self.failed_rows += left
+            logger.error(
+                "Write-behind gave up on %d queued rows after %.1fs",
+                left, self.shutdown_timeout)
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        self.stopping = False
+
+    async def _run(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - loop.time()
+                if remaining <= 0 or self.stopping:
+                    break
+                self.filled.clear()
+                try:
+                    await asyncio.wait_for(self.filled.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            try:
+                await self.flush(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def flush(self, batch) -> None:
+        rows = defaultdict(list)
+        for model, row in batch:
+            rows[model].append(row)
+        start = time.perf_counter()
+        for model, model_rows in rows.items():
+            try:
+                await model.bulk_create(model_rows)
+            except Exception:
+                await self.flush_each(model, model_rows)
+        elapsed = time.perf_counter() - start
+        self.flushes += 1
+        self.rows += len(batch)
+        self.batch_size_max = max(self.batch_size_max, len(batch))
+        self.flush_seconds_total += elapsed
+        self.flush_seconds_max = max(self.flush_seconds_max, elapsed)
+
+    async def flush_each(self, model, rows) -> None:
+        failed = 0
+        for row in rows:
+            try:
+                await model.bulk_create([row])
+            except Exception:
+                if not failed:
+                    logger.exception(
+                        "Write-behind failed to write a %s row",
+                        model.__tablename__)
+                failed += 1
+        if failed:
+            self.failed_rows += failed
+            logger.error(
+                "Write-behind dropped %d of %d %s rows",
+                failed, len(rows), model.__tablename__)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "max_queue": self.max_queue,
+            "blocked": self.blocked,
+            "flushes": self.flushes,
+            "rows": self.rows,
+            "failed_rows": self.failed_rows,
+            "batch_size_avg": self.rows / self.flushes if self.flushes else 0.0,
+            "batch_size_max": self.batch_size_max,
+            "flush_seconds_avg": (
+                self.flush_seconds_total / self.flushes if self.flushes else 0.0),
+            "flush_seconds_max": self.flush_seconds_max,
+        }
+
+"""
+LIMITER = """
+import time
+
+# share of the limit each priority may fill; critical requests (health
+# checks) are always let in, low priority ones are shed first
+PRIORITY_SHARES = {"critical": None, "high": 1.0, "normal": 0.8, "low": 0.5}
+SHORT_RTT_WEIGHT = 0.1
+LONG_RTT_WEIGHT = 0.01
+
+
+def parse_priorities(items) -> list:
+    # "path-prefix=priority" items, longest prefix first
+    priorities = []
+    for item in items:
+        if not item.strip():
+            continue
+        prefix, _, priority = item.partition("=")
+        priority = priority.strip()
+        if priority not in PRIORITY_SHARES:
+            raise ValueError("Unknown priority %r for %r" % (priority, prefix))
+        priorities.append((prefix.strip(), priority))
+    return sorted(priorities, key=lambda item: -len(item[0]))
+
+
+# AIMD on in-flight requests. Each response start is a latency sample: the
+# limit drops by `backoff` (at most once per typical response time) when
+# requests wait for a pool connection or recent latency exceeds the long
+# run average by `tolerance`, and otherwise grows by about one per limit's
+# worth of responses while the limit is in use.
+class AdaptiveLimiter:
+
+    def __init__(
+            self, pool_monitor=None, initial=20, min_limit=5, max_limit=200,
+            backoff=0.9, tolerance=2.0, priorities=()):
+        self.pool_monitor = pool_monitor
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.priorities = parse_priorities(priorities)
+        self.inflight = 0
+        self.short_rtt = None
+        self.long_rtt = None
+        self.last_decrease = 0.0
+        self.decreases = 0
+        self.admitted = 0
+        self.shed = dict.fromkeys(PRIORITY_SHARES, 0)
+
+    def priority(self, path: str) -> str:
+        for prefix, priority in self.priorities:
+            if path.startswith(prefix):
+                return priority
+        return "normal"
+
+    def acquire(self, priority: str) -> bool:
+        share = PRIORITY_SHARES[priority]
+        if share is not None and self.inflight >= self.limit * share:
+            self.shed[priority] += 1
+            return False
+        self.inflight += 1
+        self.admitted += 1
+        return True
+
+    def release(self) -> None:
+        self.inflight -= 1
+
+    def sample(self, rtt: float) -> None:
+        if self.long_rtt is None:
+            self.short_rtt = self.long_rtt = rtt
+        else:
+            self.short_rtt += (rtt - self.short_rtt) * SHORT_RTT_WEIGHT
+            self.long_rtt += (rtt - self.long_rtt) * LONG_RTT_WEIGHT
+        waiting = self.pool_monitor.waiting if self.pool_monitor else 0
+        if waiting or self.short_rtt > self.long_rtt * self.tolerance:
+            now = time.monotonic()
+            if now - self.last_decrease >= self.long_rtt:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self.last_decrease = now
+                self.decreases += 1
+        elif self.inflight >= self.limit / 2:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "inflight": self.inflight,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "decreases": self.decreases,
+            "short_rtt": self.short_rtt,
+            "long_rtt": self.long_rtt,
+        }
 
 """
+METRICS = """
+import asyncio
+import logging
+import os
+import time
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess)
+from starlette.responses import Response
+from starlette.types import Scope
+from app.core.pool import DeadlineConnection
+from app.core.tracing import STATEMENT_MAX_LENGTH, span
+
+logger = logging.getLogger(__name__)
+
+# Under several uvicorn/gunicorn workers, export PROMETHEUS_MULTIPROC_DIR
+# (an empty directory, cleared before the server starts) in the process
+# environment: each worker then writes its samples there and /metrics adds
+# them up across workers. It is read when this module is imported.
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+OPERATIONS = {
+    "select", "insert", "update", "delete", "with", "begin", "commit",
+    "rollback", "copy"}
+# up to the default request deadline
+REQUEST_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUERY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0)
+
+REQUESTS = Counter(
+    "http_requests_total", "HTTP requests by route template and status class",
+    ("method", "route", "status"))
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Time to the end of the response body",
+    ("method", "route"), buckets=REQUEST_BUCKETS)
+QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "asyncpg statement time, results included",
+    ("operation",), buckets=QUERY_BUCKETS)
+# livesum: the sum over the workers that are still running
+POOL_CONNECTIONS = Gauge(
+    "db_pool_connections", "Open pool connections by state",
+    ("pool", "state"), multiprocess_mode="livesum")
+POOL_MAX_SIZE = Gauge(
+    "db_pool_max_size", "Pool size limit",
+    ("pool",), multiprocess_mode="livesum")
+POOL_WAITING = Gauge(
+    "db_pool_waiting", "Callers waiting for a connection",
+    ("pool",), multiprocess_mode="livesum")
+
+# labels() takes a lock and builds a key on every call; on the hot path the
+# children are looked up here once per label set instead
+_request_children = {}
+_query_children = {}
+# route endpoint: declared path, built on the first request
+_route_templates = None
+
+
+def route_template(scope: Scope) -> str:
+    # the path the route was declared with, so /tests/{id} is one series
+    global _route_templates
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    if _route_templates is None:
+        _route_templates = {
+            getattr(route, "endpoint", None) or route.app: route.path
+            for route in scope["app"].routes}
+    return _route_templates.get(endpoint, "unmatched")
+
+
+def observe_request(scope: Scope, status: int, elapsed: float) -> None:
+    method = scope["method"] if scope["method"] in METHODS else "other"
+    key = (method, route_template(scope), status // 100)
+    children = _request_children.get(key)
+    if children is None:
+        children = _request_children[key] = (
+            REQUESTS.labels(key[0], key[1], "%dxx" % key[2]),
+            REQUEST_DURATION.labels(key[0], key[1]))
+    children[0].inc()
+    children[1].observe(elapsed)
+
+
+def observe_query(query: str, elapsed: float) -> None:
+    words = query[:16].split(None, 1)
+    operation = words[0].lower() if words else ""
+    if operation not in OPERATIONS:
+        operation = "other"
+    child = _query_children.get(operation)
+    if child is None:
+        child = _query_children[operation] = QUERY_DURATION.labels(operation)
+    child.observe(elapsed)
+
+
+# connection_class for the pools when metrics or tracing are enabled:
+# statement durations, and a span per statement in traced requests
+class InstrumentedConnection(DeadlineConnection):
+
+    async def _do_execute(self, query, executor, timeout, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            with span("db_query", statement=query[:STATEMENT_MAX_LENGTH]):
+                return await super()._do_execute(
+                    query, executor, timeout, *args, **kwargs)
+        finally:
+            observe_query(query, time.perf_counter() - start)
+
+
+# Copies the PoolMonitor numbers of the primary and the replicas into the
+# pool gauges every `interval` seconds, and on each scrape.
+class PoolMetrics:
+
+    def __init__(self, pool_monitor, replicas, interval: float = 5.0) -> None:
+        self.pool_monitor = pool_monitor
+        self.replicas = replicas
+        self.interval = interval
+        self._task = None
+
+    def monitors(self):
+        yield "primary", self.pool_monitor
+        for replica in self.replicas.replicas:
+            yield replica.name, replica.monitor
+
+    def update(self) -> None:
+        for name, monitor in self.monitors():
+            stats = monitor.stats()
+            if not stats:
+                continue
+            POOL_CONNECTIONS.labels(name, "in_use").set(stats["in_use"])
+            POOL_CONNECTIONS.labels(name, "idle").set(stats["idle"])
+            POOL_MAX_SIZE.labels(name).set(stats["max_size"])
+            POOL_WAITING.labels(name).set(stats["waiting"])
+
+    async def start(self) -> None:
+        self.update()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if MULTIPROCESS:
+            # drops this worker's livesum gauges
+            multiprocess.mark_process_dead(os.getpid())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.update()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("updating pool metrics failed")
+
+    def response(self) -> Response:
+        self.update()
+        if MULTIPROCESS:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+"""
+TRACING = """
+import asyncio
+import json
+import logging
+import random
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# W3C trace context, https://www.w3.org/TR/trace-context/
+TRACEPARENT = "traceparent"
+HEX = set("0123456789abcdef")
+# longer statements are cut in the exported span
+STATEMENT_MAX_LENGTH = 2000
+
+_current = ContextVar("span", default=None)
+
+
+class Span:
+    __slots__ = (
+        "tracer", "name", "trace_id", "span_id", "parent_id", "sampled",
+        "attributes", "status", "start", "_started")
+
+    def __init__(self, tracer, name, trace_id, parent_id, sampled, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = attributes
+        self.status = "ok"
+        self.start = time.time()
+        self._started = time.perf_counter()
+
+    def set(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def traceparent(self) -> str:
+        return "00-%s-%s-%s" % (
+            self.trace_id, self.span_id, "01" if self.sampled else "00")
+
+    def child(self, name: str, attributes: dict) -> "Span":
+        return Span(
+            self.tracer, name, self.trace_id, self.span_id, self.sampled,
+            attributes)
+
+    def finish(self) -> None:
+        if self.sampled:
+            self.tracer.exporter.export({
+                "trace_id": self.trace_id,
+                "span_id": self.span_id,
+                "parent_id": self.parent_id,
+                "name": self.name,
+                "start": self.start,
+                "duration_ms": (time.perf_counter() - self._started) * 1000,
+                "status": self.status,
+                "attributes": self.attributes,
+            })
+
+
+def parse_traceparent(value: Optional[str]):
+    # (trace id, parent span id, sampled), or None if absent or invalid
+    if not value:
+        return None
+    parts = value.strip().split("-")
+    if len(parts) < 4:
+        return None
+    version, trace_id, parent_id, flags = parts[:4]
+    if (len(version) != 2 or version == "ff" or len(trace_id) != 32
+            or len(parent_id) != 16 or len(flags) != 2
+            or (version == "00" and len(parts) != 4)
+            or not set(version + trace_id + parent_id + flags) <= HEX
+            or trace_id == "0" * 32 or parent_id == "0" * 16):
+        return None
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def set_current(span: Optional[Span]):
+    return _current.set(span)
+
+
+def reset(token) -> None:
+    _current.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    # a child of the current span; nothing is recorded when the request is
+    # not sampled, or outside a request
+    parent = _current.get()
+    if parent is None or not parent.sampled:
+        yield None
+        return
+    child = parent.child(name, attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except asyncio.CancelledError:
+        child.status = "cancelled"
+        raise
+    except Exception as e:
+        child.status = "error"
+        child.attributes["error"] = repr(e)[:200]
+        raise
+    finally:
+        _current.reset(token)
+        child.finish()
+
+
+# Headers for an outbound call, so the service called joins the trace:
+#
+#     with span("http_client", url=url):
+#         await client.get(url, timeout=budget(5.0),
+#                          headers=inject(outbound_headers()))
+def inject(headers: Optional[dict] = None) -> dict:
+    headers = dict(headers or {})
+    current = _current.get()
+    if current is not None:
+        headers[TRACEPARENT] = current.traceparent()
+    return headers
+
+
+class Tracer:
+
+    def __init__(self, exporter, ratio: float = 0.05,
+                 trust_parent: bool = False) -> None:
+        self.exporter = exporter
+        self.ratio = ratio
+        self.bound = int(ratio * (1 << 64))
+        self.trust_parent = trust_parent
+
+    def sampled(self, trace_id: str) -> bool:
+        # on the low 64 bits of the trace id, as OpenTelemetry's
+        # TraceIdRatioBased, so services with one ratio agree on a trace
+        return int(trace_id[16:], 16) < self.bound
+
+    def start(self, name: str, traceparent: Optional[str] = None,
+              **attributes) -> Span:
+        # a root span, continuing the caller's trace when it sent a valid
+        # traceparent. Its sampled flag is followed as is only from trusted
+        # callers; from others it is sampled at the ratio too, by a coin
+        # toss, as they pick the trace id
+        parent = parse_traceparent(traceparent)
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+            if sampled and not self.trust_parent:
+                sampled = random.random() < self.ratio
+        else:
+            trace_id = "%032x" % random.getrandbits(128)
+            parent_id = None
+            sampled = self.sampled(trace_id)
+        return Span(self, name, trace_id, parent_id, sampled, attributes)
+
+
+# Writes finished spans as JSON lines to a file, or stdout for "-". Spans
+# are queued in memory and written every flush_interval seconds off the
+# event loop; past max_queue they are dropped and counted.
+class JsonLinesExporter:
+
+    def __init__(self, path: str = "-", flush_interval: float = 1.0,
+                 max_queue: int = 10000) -> None:
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.queue = []
+        self.exported = 0
+        self.dropped = 0
+        self._task = None
+
+    def export(self, record: dict) -> None:
+        if len(self.queue) >= self.max_queue:
+            self.dropped += 1
+            return
+        self.queue.append(record)
+
+    async def start(self) -> None:
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("exporting spans failed")
+
+    async def flush(self) -> None:
+        if not self.queue:
+            return
+        records, self.queue = self.queue, []
+        await asyncio.get_event_loop().run_in_executor(None, self.write, records)
+        self.exported += len(records)
+
+    def write(self, records: list) -> None:
+        # in the executor, encoding included
+        data = "".join(
+            json.dumps(record, default=str, separators=(",", ":")) + "\\n"
+            for record in records)
+        if self.path == "-":
+            sys.stdout.write(data)
+            sys.stdout.flush()
+            return
+        with open(self.path, "a") as output:
+            output.write(data)
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self.queue),
+            "exported": self.exported,
+            "dropped": self.dropped,
+        }
 
+"""
 DOCKER_COMPOSE = """
 version: '3.3'
 services:
@@ -561,6 +4236,7 @@ fileConfig(config.config_file_name)
 # for 'autogenerate' support
 sys.path.append(str(pathlib.Path(__file__).resolve().parents[3]))
 from app.main import db as target_metadata      # noqa
+from app.core.partitions import is_partition    # noqa
 
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
@@ -577,12 +4253,22 @@ def render_item(type_, obj, autogen_context):
         autogen_context.imports.add("import uuid")
         autogen_context.imports.add("import gino")
 
+        # stdlib only, so a migration runs without the app's settings; rows
+        # the app inserts get their ids from uuid_generators()
         return "sqlalchemy_utils.types.uuid.UUIDType(), default=uuid.uuid4"
 
     # Default rendering for other objects
     return False
 
 
+def include_object(object, name, type_, reflected, compare_to):
+    # partitions of TimePartitioned tables are made by `doit partitions`;
+    # the parent is rendered with postgresql_partition_by
+    if type_ == "table" and reflected and compare_to is None:
+        return not is_partition(name)
+    return True
+
+
 def run_migrations_offline():
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
@@ -590,6 +4276,7 @@ def run_migrations_offline():
         target_metadata=target_metadata,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
+        include_object=include_object,
     )
 
     with context.begin_transaction():
@@ -606,7 +4293,7 @@ def run_migrations_online():
     with connectable.connect() as connection:
         context.configure(
             connection=connection, target_metadata=target_metadata,
-            render_item=render_item
+            render_item=render_item, include_object=include_object
         )
 
         with context.begin_transaction():
@@ -654,6 +4341,398 @@ format = %(levelname)-5.5s [%(name)s] %(message)s
 datefmt = %H:%M:%S
 """
 
+BENCH_SUCCESS_HEADER = """
+import asyncio
+import time
+from starlette.applications import Starlette
+from starlette.middleware.base import (
+    BaseHTTPMiddleware,
+    RequestResponseEndpoint)
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from app.core.middlewares import SUCCESS_MEDIA_TYPE, CustomSuccessHeader
+
+REQUESTS = 20000
+SCOPE = {
+    "type": "http",
+    "http_version": "1.1",
+    "method": "GET",
+    "scheme": "http",
+    "path": "/",
+    "raw_path": b"/",
+    "root_path": "",
+    "query_string": b"",
+    "headers": [(b"host", b"bench")],
+    "server": ("bench", 80),
+    "client": ("127.0.0.1", 5000),
+}
+
+
+class BaseHTTPSuccessHeader(BaseHTTPMiddleware):
+    async def dispatch(
+            self,
+            request: Request,
+            call_next: RequestResponseEndpoint) -> Response:
+        response = await call_next(request)
+        if response.headers["Content-Type"] == "application/json":
+            response.headers["Content-Type"] = SUCCESS_MEDIA_TYPE
+        return response
+
+
+async def endpoint(request):
+    return JSONResponse({
+        "type": "vnd.test.service.entity",
+        "code": 200,
+        "message": "OK",
+        "details": {"id": 1, "name": "bench"}})
+
+
+def receiver():
+    messages = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    # behave like a connected client: after the request body, block until
+    # the server stops listening for a disconnect
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.Event().wait()
+    return receive
+
+
+async def send(message):
+    pass
+
+
+async def measure(middleware):
+    app = Starlette(routes=[Route("/", endpoint)])
+    app.add_middleware(middleware)
+    for _ in range(REQUESTS // 10):
+        await app(dict(SCOPE), receiver(), send)
+    timings = []
+    for _ in range(REQUESTS):
+        start = time.perf_counter()
+        await app(dict(SCOPE), receiver(), send)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    mean = sum(timings) / len(timings)
+    p99 = timings[int(len(timings) * 0.99)]
+    print(f"{middleware.__name__:<24} mean {mean * 1e6:8.1f}us  "
+          f"p99 {p99 * 1e6:8.1f}us  {1 / mean:10.0f} req/s")
+    return mean
+
+
+async def main():
+    base = await measure(BaseHTTPSuccessHeader)
+    pure = await measure(CustomSuccessHeader)
+    print(f"saved {(base - pure) * 1e6:.1f}us per request")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
+"""
+
+BENCH_BULK_CREATE = """
+import asyncio
+import time
+from app.core.dbsetup import Model, db
+from app.core.factories import settings
+
+ROWS = 20000
+SINGLE_ROWS = 2000
+
+
+class BenchRow(Model):
+    __tablename__ = "bench_bulk_create"
+
+    name = db.Column(db.String(), nullable=False)
+    value = db.Column(db.Integer(), nullable=False)
+
+
+def make_rows(count):
+    return [{"name": "row-%d" % i, "value": i} for i in range(count)]
+
+
+async def measure(label, count, insert):
+    await db.status(db.text("TRUNCATE bench_bulk_create"))
+    start = time.perf_counter()
+    await insert(make_rows(count))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24} {count:>7} rows {elapsed:8.3f}s "
+          f"{count / elapsed:12.0f} rows/s")
+
+
+async def create_each(rows):
+    for row in rows:
+        await BenchRow.create(**row)
+
+
+async def main():
+    await db.set_bind(settings.DATABASE_URL)
+    await db.gino.create_all(tables=[BenchRow.__table__])
+    try:
+        await measure("Model.create", SINGLE_ROWS, create_each)
+        await measure(
+            "bulk_create (VALUES)", ROWS,
+            lambda rows: BenchRow.bulk_create(rows, use_copy=False))
+        await measure("bulk_create (COPY)", ROWS, BenchRow.bulk_create)
+    finally:
+        await db.gino.drop_all(tables=[BenchRow.__table__])
+        await db.pop_bind().close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
+"""
+
+BENCH_PAGINATION = """
+import asyncio
+import statistics
+import time
+from datetime import datetime, timedelta
+from app.core.dbsetup import Model, db
+from app.core.factories import settings
+from app.utils.pagination import encode_cursor, paginate
+
+ROWS = 200000
+PAGE_SIZE = 50
+DEPTHS = [0, 1000, 10000, 100000, ROWS - PAGE_SIZE]
+REPEAT = 20
+
+
+class BenchPage(Model):
+    __tablename__ = "bench_pagination"
+
+    value = db.Column(db.Integer(), nullable=False)
+    _created_id_idx = db.Index("ix_bench_pagination_created_id", "created", "id")
+
+
+async def timed(fetch):
+    timings = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        await fetch()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+async def main():
+    await db.set_bind(settings.DATABASE_URL)
+    await db.gino.create_all(tables=[BenchPage.__table__])
+    try:
+        start = datetime.utcnow()
+        await BenchPage.bulk_create(
+            {"value": i, "created": start + timedelta(milliseconds=i)}
+            for i in range(ROWS))
+        await db.status(db.text("ANALYZE bench_pagination"))
+        ordered = BenchPage.query.order_by(BenchPage.created, BenchPage.id)
+        print(f"{'depth':>8} {'offset ms':>10} {'keyset ms':>10}")
+        for depth in DEPTHS:
+            cursor = None
+            if depth:
+                row = await ordered.offset(depth - 1).limit(1).gino.first()
+                cursor = encode_cursor(row.created, row.id)
+            offset_ms = await timed(
+                lambda: ordered.offset(depth).limit(PAGE_SIZE).gino.all())
+            keyset_ms = await timed(
+                lambda: paginate(BenchPage, cursor=cursor, limit=PAGE_SIZE))
+            print(f"{depth:>8} {offset_ms:>10.2f} {keyset_ms:>10.2f}")
+    finally:
+        await db.gino.drop_all(tables=[BenchPage.__table__])
+        await db.pop_bind().close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
+"""
+
+BENCH_JSON = """
+import os
+import statistics
+import time
+from datetime import datetime
+from asyncpg.pgproto.pgproto import UUID
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+from app.api.schema.generic_schema import SuccessResponseSchema
+from app.utils.negotiation import negotiate, reset
+from app.utils.responses import FastJSONResponse, envelope_response
+
+SIZES = [1, 50, 500]
+REPEAT = 200
+
+
+def make_rows(count):
+    now = datetime.utcnow()
+    return [
+        {
+            "id": UUID(os.urandom(16)),
+            "created": now,
+            "updated": now,
+            "_created": now.time(),
+            "name": "row %d" % i,
+            "value": i,
+            "active": bool(i % 2),
+        }
+        for i in range(count)]
+
+
+def current(rows):
+    return JSONResponse(content=jsonable_encoder(SuccessResponseSchema(
+        type="bench", code=200, message="OK", details=rows)))
+
+
+def validated(rows):
+    return FastJSONResponse(SuccessResponseSchema(
+        type="bench", code=200, message="OK", details=rows))
+
+
+def trusted(rows):
+    return envelope_response(
+        SuccessResponseSchema, type="bench", message="OK", details=rows)
+
+
+def trusted_msgpack(rows):
+    token = negotiate("application/msgpack")
+    try:
+        return trusted(rows)
+    finally:
+        reset(token)
+
+
+def timed(render, rows):
+    timings = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        render(rows)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000000
+
+
+def main():
+    rows = make_rows(1)
+    assert current(rows).body == trusted(rows).body == validated(rows).body
+    print(f"{'rows':>6} {'current us':>11} {'validated us':>13} "
+          f"{'trusted us':>11} {'msgpack us':>11} {'json B':>8} {'msgpack B':>10}")
+    for size in SIZES:
+        rows = make_rows(size)
+        print(f"{size:>6} {timed(current, rows):>11.1f} "
+              f"{timed(validated, rows):>13.1f} {timed(trusted, rows):>11.1f} "
+              f"{timed(trusted_msgpack, rows):>11.1f} "
+              f"{len(trusted(rows).body):>8} {len(trusted_msgpack(rows).body):>10}")
+
+
+if __name__ == "__main__":
+    main()
+"""
+PRECOMPRESS_SUFFIXES = (
+    ".css", ".js", ".mjs", ".map", ".html", ".svg", ".json", ".txt", ".xml",
+    ".ico", ".wasm",
+)
+
+BENCH_UUID = """
+import asyncio
+import time
+import uuid
+from app.core.dbsetup import Model, db
+from app.core.factories import settings
+from app.utils.ids import uuid4_batch, uuid7, uuid7_batch
+
+GENERATED = 200000
+ROWS = 200000
+BATCH = 1000
+
+
+class BenchUUID4(Model):
+    __tablename__ = "bench_uuid4"
+    uuid_version = 4
+
+    value = db.Column(db.Integer(), nullable=False)
+
+
+class BenchUUID7(Model):
+    __tablename__ = "bench_uuid7"
+    uuid_version = 7
+
+    value = db.Column(db.Integer(), nullable=False)
+
+
+def measure_generator(label, generate):
+    start = time.perf_counter()
+    generate()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24} {GENERATED / elapsed:12.0f} ids/s")
+
+
+async def measure_inserts(model):
+    table = model.__tablename__
+    await db.status(db.text("TRUNCATE %s" % table))
+    start = time.perf_counter()
+    for offset in range(0, ROWS, BATCH):
+        await model.bulk_create(
+            {"value": i} for i in range(offset, offset + BATCH))
+    elapsed = time.perf_counter() - start
+    index_size = await db.scalar(db.text(
+        "SELECT pg_relation_size('%s_pkey')" % table))
+    print(f"{table:<24} {ROWS / elapsed:12.0f} rows/s "
+          f"pkey {index_size / 1024 / 1024:8.1f} MiB")
+
+
+async def main():
+    measure_generator("uuid.uuid4", lambda: [
+        uuid.uuid4() for _ in range(GENERATED)])
+    measure_generator("uuid4_batch", lambda: uuid4_batch(GENERATED))
+    measure_generator("uuid7", lambda: [uuid7() for _ in range(GENERATED)])
+    measure_generator("uuid7_batch", lambda: uuid7_batch(GENERATED))
+
+    await db.set_bind(settings.DATABASE_URL)
+    tables = [BenchUUID4.__table__, BenchUUID7.__table__]
+    await db.gino.create_all(tables=tables)
+    try:
+        # batches of BATCH rows, as a steady stream of inserts would arrive
+        await measure_inserts(BenchUUID4)
+        await measure_inserts(BenchUUID7)
+    finally:
+        await db.gino.drop_all(tables=tables)
+        await db.pop_bind().close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
+"""
+BENCHMARKS = {
+    "success_header": BENCH_SUCCESS_HEADER,
+    "bulk_create": BENCH_BULK_CREATE,
+    "pagination": BENCH_PAGINATION,
+    "json": BENCH_JSON,
+    "uuid": BENCH_UUID,
+}
+
+
+# A bare `doit` scaffolds and starts the service; openapi, partitions and
+# benchmark need a migrated database, so they only run when named
+DOIT_CONFIG = {
+    'default_tasks': [
+        'create_directories',
+        'create_venv',
+        'install_dependencies',
+        'freeze',
+        'alembic',
+        'create_env',
+        'replace_alembic',
+        'replace_alembic_env',
+        'dockercompose',
+        'setup_test_controller',
+        'setup_model',
+        'precompress_static',
+        'set_env',
+        'docker_db',
+        'execute_first_migration',
+        'sync_first_migration',
+        'run_server',
+    ],
+}
+
 
 def try_except_init(path):
     "Creates __init__.py file for every directory"
@@ -689,11 +4768,14 @@ def task_create_directories():
                                 with open(p, "a") as output:
                                     output.write(GENERIC_EXCEPTION)
                     if pa == "app/api/schema":
-                        for item in ["generic_schema.py"]:
+                        for item in ["generic_schema.py", "batch_schema.py"]:
                             p = os.path.join(pa, item)
                             if item == "generic_schema.py":
                                 with open(p, "a") as output:
                                     output.write(GENERIC_SCHEMA)
+                            if item == "batch_schema.py":
+                                with open(p, "a") as output:
+                                    output.write(BATCH_SCHEMA)
             if path == "app/test":
                 for dir in ['api', 'resources']:
                     pa = os.path.join(path, dir)
@@ -722,10 +4804,38 @@ def task_create_directories():
                     output.write(DB_SETUP)
                 with open(os.path.join(path, "extensions.py"), "a") as output:
                     output.write(EXTENTIONS)
+                with open(os.path.join(path, "pool.py"), "a") as output:
+                    output.write(POOL)
+                with open(os.path.join(path, "replicas.py"), "a") as output:
+                    output.write(REPLICAS)
+                with open(os.path.join(path, "invalidation.py"), "a") as output:
+                    output.write(INVALIDATION)
+                with open(os.path.join(path, "static.py"), "a") as output:
+                    output.write(STATIC_FILES)
+                with open(os.path.join(path, "warmup.py"), "a") as output:
+                    output.write(WARMUP)
+                with open(os.path.join(path, "middlewares.py"), "a") as output:
+                    output.write(MIDDLEWARES)
+                with open(os.path.join(path, "openapi.py"), "a") as output:
+                    output.write(OPENAPI)
+                with open(os.path.join(path, "partitions.py"), "a") as output:
+                    output.write(PARTITIONS)
+                with open(os.path.join(path, "writebehind.py"), "a") as output:
+                    output.write(WRITE_BEHIND)
+                with open(os.path.join(path, "limiter.py"), "a") as output:
+                    output.write(LIMITER)
+                with open(os.path.join(path, "metrics.py"), "a") as output:
+                    output.write(METRICS)
+                with open(os.path.join(path, "tracing.py"), "a") as output:
+                    output.write(TRACING)
 
             if path == "app/utils":
                 try_except_init(path)
-                for item in ["helper.py", "singleton_type.py", "types.py", "headers.py"]:
+                for item in ["helper.py", "singleton_type.py", "types.py", "headers.py",
+                             "pagination.py", "streaming.py", "cache.py",
+                             "responses.py", "negotiation.py", "conditional.py",
+                             "singleflight.py", "batch.py", "loader.py",
+                             "ids.py", "deadlines.py"]:
                     p = os.path.join(path, item)
                     if item == "helper.py":
                         with open(p, "a") as output:
@@ -739,6 +4849,39 @@ def task_create_directories():
                     if item == "headers.py":
                         with open(p, "a") as output:
                             output.write(UTIL_HEADERS)
+                    if item == "pagination.py":
+                        with open(p, "a") as output:
+                            output.write(UTIL_PAGINATION)
+                    if item == "streaming.py":
+                        with open(p, "a") as output:
+                            output.write(UTIL_STREAMING)
+                    if item == "cache.py":
+                        with open(p, "a") as output:
+                            output.write(UTIL_CACHE)
+                    if item == "responses.py":
+                        with open(p, "a") as output:
+                            output.write(UTIL_RESPONSES)
+                    if item == "negotiation.py":
+                        with open(p, "a") as output:
+                            output.write(UTIL_NEGOTIATION)
+                    if item == "conditional.py":
+                        with open(p, "a") as output:
+                            output.write(UTIL_CONDITIONAL)
+                    if item == "singleflight.py":
+                        with open(p, "a") as output:
+                            output.write(UTIL_SINGLEFLIGHT)
+                    if item == "batch.py":
+                        with open(p, "a") as output:
+                            output.write(UTIL_BATCH)
+                    if item == "loader.py":
+                        with open(p, "a") as output:
+                            output.write(UTIL_LOADER)
+                    if item == "ids.py":
+                        with open(p, "a") as output:
+                            output.write(UTIL_IDS)
+                    if item == "deadlines.py":
+                        with open(p, "a") as output:
+                            output.write(UTIL_DEADLINES)
     except OSError as e:
         print (e)
         pass
@@ -783,7 +4926,8 @@ def task_install_dependencies():
         " googleapis-common-protos==1.54.0 greenlet==1.1.2 grpcio==1.43.0"
         " grpcio-status==1.43.0 h11==0.12.0 httplib2==0.20.2 idna==3.3"
         " importlib-metadata==1.7.0 importlib-resources==5.4.0 Mako==1.1.6"
-        " MarkupSafe==2.0.1 msgpack==1.0.3 packaging==21.3 proto-plus==1.19.8"
+        " MarkupSafe==2.0.1 msgpack==1.0.3 orjson==3.6.5 packaging==21.3"
+        " prometheus-client==0.12.0 proto-plus==1.19.8"
         " protobuf==3.19.3 psycopg2==2.9.3 pyasn1==0.4.8 pyasn1-modules==0.2.8"
         " pycodestyle==2.8.0 pydantic==1.9.0 pyhumps==3.5.0 pyparsing==3.0.6"
         " python-dateutil==2.8.2 pytz==2021.3 requests==2.27.1 rsa==4.8"
@@ -858,6 +5002,73 @@ def task_setup_model():
         'actions': [setup_model],
     }
 
+def task_openapi():
+    """
+    Pre-build the OpenAPI document, serve it with OPENAPI_SCHEMA_FILE=docs/openapi.json
+    """
+    return {
+        'actions': ['. ./.env && venv/bin/python -m app.core.openapi docs/openapi.json'],
+        'targets': ['docs/openapi.json'],
+    }
+
+def task_partitions():
+    """
+    Create upcoming partitions of TimePartitioned models and detach expired ones; run it daily
+    """
+    return {
+        'actions': ['. ./.env && venv/bin/python -m app.core.partitions'],
+        'verbosity': 2,
+    }
+
+def task_precompress_static():
+    """
+    Write .gz (and .br, when brotli is installed) next to compressible files in app/static
+    """
+    import zlib
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+
+    def compress(path, encoding):
+        with open(path, "rb") as source:
+            data = source.read()
+        if encoding == "br":
+            compressed = brotli.compress(data, quality=11)
+        else:
+            # wbits=31: gzip container with a zero mtime, so builds are reproducible
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+            compressed = compressor.compress(data) + compressor.flush()
+        target = path + (".br" if encoding == "br" else ".gz")
+        written = len(compressed) < len(data)
+        if written:
+            with open(target, "wb") as output:
+                output.write(compressed)
+        elif os.path.exists(target):
+            os.remove(target)
+        return {'written': written}
+
+    def target_present(target):
+        # a file that does not shrink has no target; only a written one must still exist
+        def check(task, values):
+            return not values.get('written', True) or os.path.exists(target)
+        return check
+
+    encodings = ["gzip", "br"] if brotli else ["gzip"]
+    for root, _, files in os.walk("app/static"):
+        for name in files:
+            if not name.endswith(PRECOMPRESS_SUFFIXES):
+                continue
+            path = os.path.join(root, name)
+            for encoding in encodings:
+                yield {
+                    'name': f"{path}:{encoding}",
+                    'actions': [(compress, [path, encoding])],
+                    'file_dep': [path],
+                    'uptodate': [target_present(path + (".br" if encoding == "br" else ".gz"))],
+                }
+
+
 def task_set_env():
     return {
         'actions': ['source .env'],
@@ -881,4 +5092,24 @@ def task_sync_first_migration():
 def task_run_server():
     return {
         'actions': ['venv/bin/uvicorn app.main:app --reload --port 5000'],
-    }
\ No newline at end of file
+    }
+
+
+def task_benchmark():
+    """
+    Write and run the micro-benchmarks, e.g. `doit benchmark:success_header`
+    """
+    def write_benchmark(name, source):
+        os.makedirs("benchmarks", exist_ok=True)
+        try_except_init("benchmarks")
+        with open(os.path.join("benchmarks", f"{name}.py"), "w") as output:
+            output.write(source)
+
+    for name, source in BENCHMARKS.items():
+        yield {
+            'name': name,
+            'actions': [
+                (write_benchmark, [name, source]),
+                f'. ./.env && venv/bin/python -m benchmarks.{name}'],
+            'verbosity': 2,
+        }